@@ -0,0 +1,103 @@
+# bench_posts.py
+# Benchmark cho GET /posts/
+#
+# So sánh:
+# - legacy: đường cũ (ORM object + 1 query ảnh / post + validate qua PostResponse)
+# - fast:   đường mới (serialize_posts + FastJSONResponse)
+# Đo CPU / request và số byte thực tế trên dây (identity / gzip / br)
+# cho trang 100 và 1000 post.
+#
+# Chạy:  python bench_posts.py
+# (dùng DB SQLite tạm, không đụng tới autofb.db)
+
+import os
+import sys
+import tempfile
+import time
+from typing import List
+
+_tmp_dir = tempfile.mkdtemp(prefix="autofb-bench-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}"
+os.environ["RUN_SCHEDULER"] = "0"
+
+from datetime import datetime, timedelta
+
+from fastapi import Depends
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+import main
+from main import Post, PostImage, PostResponse, SessionLocal, app, get_db
+
+PAGE_SIZES = (100, 1000)
+IMAGES_PER_POST = 3
+ROUNDS = 20
+
+
+@app.get("/bench/legacy-posts/", response_model=List[PostResponse])
+async def legacy_get_posts(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+    """Bản sao của get_posts trước khi có đường serialize nhanh."""
+    posts = db.query(Post).offset(skip).limit(limit).all()
+    for post in posts:
+        post.images = db.query(PostImage).filter(PostImage.post_id == post.id).all()
+    return posts
+
+
+def seed(total: int):
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        for i in range(total):
+            post = Post(
+                user_id=1,
+                content=f"Bài viết số {i} - " + "Nội dung khuyến mãi áo thun mới. " * 8,
+                scheduled_time=now + timedelta(minutes=i),
+                posted=i % 2 == 0,
+                facebook_post_id=f"1234567890_{i}" if i % 2 == 0 else None,
+                posted_at=now if i % 2 == 0 else None,
+            )
+            db.add(post)
+            db.flush()
+            for j in range(IMAGES_PER_POST):
+                db.add(PostImage(post_id=post.id, image_path=f"uploads/{i:08d}-{j}.jpg"))
+        db.commit()
+    finally:
+        db.close()
+
+
+def measure(client: TestClient, path: str, encoding: str):
+    # Lần gọi đầu để warm-up (cache câu lệnh SQL, import...)
+    client.get(path, headers={"Accept-Encoding": encoding})
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(ROUNDS):
+        response = client.get(path, headers={"Accept-Encoding": encoding})
+    cpu_ms = (time.process_time() - cpu_start) * 1000 / ROUNDS
+    wall_ms = (time.perf_counter() - wall_start) * 1000 / ROUNDS
+    assert response.status_code == 200, response.text
+    return cpu_ms, wall_ms, response.num_bytes_downloaded, response.json()
+
+
+def main_bench():
+    main.init_db()
+    seed(max(PAGE_SIZES))
+    print(f"orjson: {'có' if main.orjson else 'không'} | brotli: {'có' if main.brotli else 'không'}")
+    print(f"{'trang':>6} {'đường':>7} {'encoding':>9} {'CPU ms/req':>11} {'wall ms/req':>12} {'bytes':>10}")
+
+    with TestClient(app) as client:
+        for size in PAGE_SIZES:
+            legacy_payload = None
+            for label, path in (("legacy", "/bench/legacy-posts/"), ("fast", "/posts/")):
+                for encoding in ("identity", "gzip", "br"):
+                    cpu_ms, wall_ms, wire_bytes, payload = measure(
+                        client, f"{path}?limit={size}", encoding
+                    )
+                    print(f"{size:>6} {label:>7} {encoding:>9} {cpu_ms:>11.2f} {wall_ms:>12.2f} {wire_bytes:>10}")
+                    if label == "legacy":
+                        legacy_payload = payload
+                    elif payload != legacy_payload:
+                        print("  !! payload của đường fast khác legacy", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -14,15 +14,28 @@
 # ------------------------------
 # IMPORTS
 # ------------------------------
+# Mốc thời gian để báo cáo thời gian khởi động (import + lifespan)
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 # FastAPI + utilities
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File
+from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Request, Query, BackgroundTasks, Header
+from fastapi.responses import Response, FileResponse, StreamingResponse, RedirectResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers, MutableHeaders
 
 # SQLAlchemy ORM
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean
+from sqlalchemy import (
+    create_engine, Column, Integer, String, DateTime, Text, Boolean, Float, Index, UniqueConstraint,
+    MetaData, case, exists, func, inspect, select, text,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.exc import SQLAlchemyError # Thêm thư viện xử lý lỗi SQLAlchemy
 
@@ -31,7 +44,7 @@ from pydantic import BaseModel
 
 # Standard / 3rd-party libs
 from datetime import datetime, timedelta, timezone
-import pytz # Thêm dòng này
+from contextlib import asynccontextmanager
 from typing import List, Optional
 import requests
 import json
@@ -39,35 +52,54 @@ import os
 import uuid
 import shutil
 import re
+import mimetypes
+import hashlib
+import random
+import base64
+import csv
+import io
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import zlib
+import asyncio
+import threading
 import traceback # <--- THÊM DÒNG NÀY ĐỂ FIX LỖI 500 TRACEBACK.PRINT_EXC()
 # Scheduler
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.date import DateTrigger
-# --- Thêm thư viện gửi email ---
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import pytz # <-- DÒNG MỚI ĐƯỢC THÊM
+from apscheduler.jobstores.base import JobLookupError
+# Thư viện nặng / ít dùng được import trễ ngay trong hàm cần dùng để khởi động nhanh:
+# - google-genai: get_gemini_client()
+# - smtplib, email.mime, pytz: send_email_notification()
 # ------------------------------
 
-# AI / Environment
+# Environment
 from dotenv import load_dotenv
-from google import genai
-from google.genai.errors import APIError 
 
-# Server runner
-import uvicorn
+# JSON nhanh + nén brotli: đều là tùy chọn, thiếu thì fallback về json chuẩn / gzip
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # ------------------------------
 # DATABASE SETUP
 # ------------------------------
-# Database URL: dùng SQLite file local tên autofb.db
-# Nếu bạn muốn dùng PostgreSQL / MySQL production thì thay cái URL này.
-SQLALCHEMY_DATABASE_URL = "sqlite:///./autofb.db"
+# Load .env trước để DATABASE_URL (nếu có) được áp dụng
+load_dotenv()
+
+# Database URL: mặc định dùng SQLite file local tên autofb.db
+# Nếu bạn muốn dùng PostgreSQL / MySQL production thì đặt biến môi trường DATABASE_URL.
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./autofb.db")
 
 # create_engine tạo engine kết nối DB.
 # connect_args={"check_same_thread": False} là cần thiết với SQLite khi dùng trong multithread (FastAPI + uvicorn).
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+connect_args = {"check_same_thread": False} if SQLALCHEMY_DATABASE_URL.startswith("sqlite") else {}
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args=connect_args)
 
 # SessionLocal - factory để tạo session (khi cần truy vấn DB trong request)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -79,26 +111,100 @@ Base = declarative_base()
 # UPLOADS FOLDER
 # ------------------------------
 # Thư mục lưu file upload (ảnh). Tạo nếu chưa có.
+# File được chia vào thư mục con theo hash tên file: uploads/ab/cd/<uuid>.jpg
+# (xem media_file_path) để không có thư mục nào chứa hàng trăm nghìn file.
 UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+# Dọn file mồ côi (không còn PostImage / PostVideo nào tham chiếu):
+# - MEDIA_GC_GRACE_HOURS: upload chưa gắn vào post / post đã xóa được giữ lại bấy nhiêu giờ
+# - MEDIA_GC_BATCH_SIZE + MEDIA_GC_INTERVAL_SECONDS: giới hạn tốc độ xóa (mỗi lượt tối đa N file)
+MEDIA_GC_GRACE_HOURS = float(os.getenv("MEDIA_GC_GRACE_HOURS", 24))
+MEDIA_GC_BATCH_SIZE = int(os.getenv("MEDIA_GC_BATCH_SIZE", 100))
+MEDIA_GC_INTERVAL_SECONDS = int(os.getenv("MEDIA_GC_INTERVAL_SECONDS", 300))
+
+# Thumbnail: chỉ sinh ở vài kích thước cố định (cạnh dài tối đa, px), lưu cache trên disk
+THUMBNAIL_SIZES = (160, 320, 640)
+THUMBNAIL_DIR = os.path.join(UPLOAD_DIR, ".thumbs")
+
+# Tên file upload là uuid duy nhất và không bao giờ bị ghi đè -> cache vĩnh viễn được
+UPLOADS_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Production: nếu đặt biến này (vd "/protected-uploads/"), backend chỉ trả header
+# X-Accel-Redirect và để Nginx gửi file. Nginx cần location internal tương ứng:
+#   location /protected-uploads/ { internal; alias /var/www/windshop/backend/uploads/; }
+MEDIA_ACCEL_REDIRECT_PREFIX = os.getenv("MEDIA_ACCEL_REDIRECT_PREFIX")
+
+# Nơi lưu file upload (xem get_media_storage):
+# - "local" (mặc định): disk của node này, trong UPLOAD_DIR
+# - "s3": object storage tương thích S3 (AWS S3, MinIO...) -> nhiều node API dùng chung file.
+#   Cần cài boto3; credentials lấy theo chuẩn boto3 (AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY...).
+#   S3_ENDPOINT_URL để trỏ tới MinIO, vd http://localhost:9000
+MEDIA_STORAGE = os.getenv("MEDIA_STORAGE", "local").lower()
+S3_BUCKET = os.getenv("S3_BUCKET", "autofb-media")
+S3_PREFIX = os.getenv("S3_PREFIX", "uploads/")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+S3_REGION = os.getenv("S3_REGION") or None
+# Đọc / ghi theo từng khối, không nạp cả file vào RAM (multipart upload khi ghi lên S3)
+STORAGE_CHUNK_SIZE = int(os.getenv("STORAGE_CHUNK_SIZE", 8 * 1024 * 1024))
+# Cache đọc-qua (read-through) trên disk local: file trên S3 được tải về 1 lần khi đăng bài /
+# sinh thumbnail, các lần sau đọc từ cache. Vượt MEDIA_CACHE_MAX_MB -> xóa file ít dùng nhất.
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join(UPLOAD_DIR, ".cache"))
+MEDIA_CACHE_MAX_MB = float(os.getenv("MEDIA_CACHE_MAX_MB", 2048))
+# File được dùng (tải về / đọc từ cache) trong bấy nhiêu giây gần đây không bị xóa khi dọn cache:
+# publisher có thể đang mở file đó
+MEDIA_CACHE_PIN_SECONDS = int(os.getenv("MEDIA_CACHE_PIN_SECONDS", 900))
+
+# Video được đăng bằng resumable upload của Facebook (start / transfer / finish),
+# gửi từng đoạn theo offset Facebook trả về, đọc từ disk -> không nạp cả file vào RAM.
+# Phiên upload phía Facebook có hạn: phiên cũ hơn VIDEO_SESSION_MAX_AGE_HOURS sẽ bị bỏ, upload lại từ đầu.
+VIDEO_SESSION_MAX_AGE_HOURS = float(os.getenv("VIDEO_SESSION_MAX_AGE_HOURS", 6))
+VIDEO_REQUEST_TIMEOUT_SECONDS = float(os.getenv("VIDEO_REQUEST_TIMEOUT_SECONDS", 300))
+
+# Pre-staging: PRESTAGE_MINUTES phút trước giờ đăng, ảnh của bài được upload sẵn lên Facebook
+# ở dạng unpublished; tới giờ chỉ còn 1 request /feed. 0 = tắt.
+# Ảnh đã stage quá PRESTAGE_MAX_AGE_HOURS (hoặc stage cho page khác) bị coi là cũ và upload lại.
+PRESTAGE_MINUTES = float(os.getenv("PRESTAGE_MINUTES", 0))
+PRESTAGE_MAX_AGE_HOURS = float(os.getenv("PRESTAGE_MAX_AGE_HOURS", 24))
+PRESTAGE_INTERVAL_SECONDS = int(os.getenv("PRESTAGE_INTERVAL_SECONDS", 60))
+PRESTAGE_BATCH_SIZE = int(os.getenv("PRESTAGE_BATCH_SIZE", 20))
+# Bài pre-stage lỗi (thiếu token, ảnh hỏng, Graph lỗi...) chỉ được thử lại sau bấy nhiêu giây,
+# để không chiếm hết lô PRESTAGE_BATCH_SIZE của các bài phía sau
+PRESTAGE_RETRY_SECONDS = int(os.getenv("PRESTAGE_RETRY_SECONDS", 300))
 
 # ------------------------------
 # DATABASE MODELS (SQLAlchemy)
 # ------------------------------
-# Load environment variables (Khóa API)
-load_dotenv()
 
 # ------------------------------
-# KHỞI TẠO CLIENT GEMINI
+# KHỞI TẠO CLIENT GEMINI (lazy)
 # ------------------------------
-gemini_key = os.getenv("GEMINI_API_KEY") # Đổi tên biến môi trường thành GEMINI_API_KEY
-if not gemini_key:
-    print("CẢNH BÁO: GEMINI_API_KEY không được tìm thấy trong .env hoặc ENV.")
-    # Khởi tạo Client không có key, nó sẽ tìm trong môi trường
-    client = genai.Client()
-else:
-    # Key có, khởi tạo Client
-    client = genai.Client(api_key=gemini_key)
+# Client (và thư viện google-genai, import mất ~0.5s) chỉ được tạo ở lần gọi AI đầu tiên,
+# không phải lúc import main.py -> worker khởi động nhanh hơn.
+_gemini_client = None
+_gemini_lock = threading.Lock()
+
+
+def get_gemini_client():
+    """Trả Gemini client (tạo ở lần gọi đầu tiên). Trả None nếu không khởi tạo được."""
+    global _gemini_client
+    if _gemini_client is None:
+        with _gemini_lock:
+            if _gemini_client is None:
+                from google import genai
+
+                gemini_key = os.getenv("GEMINI_API_KEY") # Đổi tên biến môi trường thành GEMINI_API_KEY
+                try:
+                    if not gemini_key:
+                        print("CẢNH BÁO: GEMINI_API_KEY không được tìm thấy trong .env hoặc ENV.")
+                        # Khởi tạo Client không có key, nó sẽ tìm trong môi trường
+                        _gemini_client = genai.Client()
+                    else:
+                        # Key có, khởi tạo Client
+                        _gemini_client = genai.Client(api_key=gemini_key)
+                except Exception as e:
+                    print(f"LỖI KHỞI TẠO GEMINI CLIENT: {e}")
+                    return None
+    return _gemini_client
 # ------------------------------
 
  
@@ -120,6 +226,11 @@ def send_email_notification(post_id: int, post_content: str, facebook_post_id: s
         print("CẢNH BÁO: Không đủ thông tin cấu hình email (server, user, password). Bỏ qua gửi email.")
         return
 
+    # Import trễ: chỉ nạp smtplib / email khi thực sự gửi email
+    import smtplib
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+
     # --- LOGIC CHUYỂN ĐỔI GIỜ UTC SANG GIỜ VIỆT NAM (ICT, UTC+7) ---
     vietnam_time_str = "Lỗi chuyển đổi múi giờ"
     try:
@@ -127,6 +238,7 @@ def send_email_notification(post_id: int, post_content: str, facebook_post_id: s
         if posted_at.tzinfo is None or posted_at.tzinfo.utcoffset(posted_at) is None:
             posted_at = posted_at.replace(tzinfo=timezone.utc)
             
+        import pytz
         vietnam_tz = pytz.timezone('Asia/Ho_Chi_Minh')
         vietnam_time = posted_at.astimezone(vietnam_tz)
         vietnam_time_str = vietnam_time.strftime('%Y-%m-%d %H:%M:%S ICT')
@@ -211,17 +323,43 @@ class FacebookToken(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
 
 
+class PostStatus:
+    """
+    Trạng thái đăng bài (cột posts.status):
+    pending -> publishing -> posted
+                          -> retry_wait -> publishing ... (backoff có jitter)
+                          -> failed (dead-letter, sau PUBLISH_MAX_ATTEMPTS lần)
+    """
+    PENDING = "pending"
+    PUBLISHING = "publishing"
+    RETRY_WAIT = "retry_wait"
+    FAILED = "failed"
+    POSTED = "posted"
+
+
 class Post(Base):
     """
     Bảng posts:
-    - user_id: id người tạo
+    - user_id: id người tạo (tenant; dispatcher chia lượt đăng công bằng theo cột này)
     - content: nội dung bài
     - scheduled_time: thời gian dự định đăng (datetime)
     - posted: boolean (đã được đăng chưa)
     - facebook_post_id: id trả về từ Facebook sau khi đăng
     - created_at, posted_at
+    - status, attempt_count, last_error: trạng thái đăng (xem PostStatus)
+    - next_attempt_at: lúc cần xử lý tiếp (giờ đăng / giờ retry / hạn lease khi đang publishing)
+    - page_id: page Facebook dùng ở lần đăng gần nhất (dùng cho thống kê)
+    - publish_lag_seconds: posted_at - scheduled_time khi đăng thành công (độ chính xác giờ đăng)
+    - prestage_attempted_at, prestage_error: lần pre-stage ảnh gần nhất và lỗi của lần đó (nếu có)
     """
     __tablename__ = "posts"
+    __table_args__ = (
+        Index("ix_posts_status_next_attempt_at", "status", "next_attempt_at"),
+        Index("ix_posts_user_status_next_attempt_at", "user_id", "status", "next_attempt_at"),
+        Index("ix_posts_status_posted_at", "status", "posted_at"),
+        # id không bao giờ được cấp lại (kể cả khi bài id lớn nhất bị xóa / chuyển sang archive)
+        {"sqlite_autoincrement": True},
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, index=True)
@@ -231,6 +369,14 @@ class Post(Base):
     facebook_post_id = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     posted_at = Column(DateTime, nullable=True)
+    status = Column(String, default=PostStatus.PENDING)
+    attempt_count = Column(Integer, default=0)
+    last_error = Column(Text, nullable=True)
+    next_attempt_at = Column(DateTime, nullable=True)
+    page_id = Column(String, nullable=True)
+    publish_lag_seconds = Column(Float, nullable=True)
+    prestage_attempted_at = Column(DateTime, nullable=True)
+    prestage_error = Column(Text, nullable=True)
 
 
 class PostImage(Base):
@@ -240,6 +386,8 @@ class PostImage(Base):
     - image_url: nếu ảnh là URL ngoài (không upload)
     - image_path: nếu ảnh được upload và lưu ở UPLOAD_DIR
     - facebook_photo_id: ID ảnh sau khi upload lên Facebook (nếu có)
+    - facebook_photo_uploaded_at, facebook_page_id: lúc upload và page nhận ảnh
+      (ảnh pre-stage quá cũ / khác page sẽ được upload lại)
     """
     __tablename__ = "post_images"
     
@@ -248,10 +396,221 @@ class PostImage(Base):
     image_url = Column(String, nullable=True)  # External URL
     image_path = Column(String, nullable=True)  # Local file path
     facebook_photo_id = Column(String, nullable=True)  # Facebook photo ID after upload
+    facebook_photo_uploaded_at = Column(DateTime, nullable=True)
+    facebook_page_id = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class PostVideo(Base):
+    """
+    Bảng post_videos: video kèm bài đăng (mỗi bài tối đa 1 video, không kèm ảnh)
+    - video_path: file đã upload lên server (UPLOAD_DIR)
+    - upload_session_id, facebook_video_id: phiên resumable upload trên Facebook (phase start)
+    - start_offset / end_offset: đoạn tiếp theo Facebook chờ nhận; start_offset là số byte
+      Facebook đã xác nhận -> lần đăng sau tiếp tục từ đây
+    - upload_started_at: lúc mở phiên (phiên quá cũ thì mở phiên mới)
+    """
+    __tablename__ = "post_videos"
+
+    id = Column(Integer, primary_key=True, index=True)
+    post_id = Column(Integer, index=True)
+    video_path = Column(String)
+    file_size = Column(Integer, nullable=True)
+    upload_session_id = Column(String, nullable=True)
+    facebook_video_id = Column(String, nullable=True)
+    start_offset = Column(Integer, default=0)
+    end_offset = Column(Integer, default=0)
+    upload_started_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class MediaFile(Base):
+    """
+    Bảng media_files: mỗi file đã upload lên server
+    - filename: tên file duy nhất (uuid.ext), cũng là tên trong URL /uploads/<filename>
+    - file_path: đường dẫn trên disk (đã chia thư mục theo hash)
+    - ref_count: số PostImage / PostVideo đang tham chiếu tới file
+    - orphaned_since: thời điểm ref_count về 0 (hoặc lúc upload) -> dùng cho GC
+    """
+    __tablename__ = "media_files"
+
+    id = Column(Integer, primary_key=True, index=True)
+    filename = Column(String, unique=True, index=True)
+    file_path = Column(String)
+    size = Column(Integer)
+    ref_count = Column(Integer, default=0)
+    orphaned_since = Column(DateTime, nullable=True, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
-# Tạo bảng nếu chưa có (chỉ tạo cấu trúc DB)
-Base.metadata.create_all(bind=engine)
+class PublishStat(Base):
+    """
+    Bảng publish_stats: số liệu đăng bài cộng dồn theo page + khung giờ / ngày (UTC)
+    - granularity: "hour" hoặc "day"; bucket_start: đầu giờ / đầu ngày
+    - publishes, failures, images: số bài đăng thành công, số lần đăng lỗi, số ảnh đã đăng
+    Được cập nhật trong cùng transaction với việc đổi trạng thái bài (xem bump_publish_stats).
+    """
+    __tablename__ = "publish_stats"
+    __table_args__ = (
+        UniqueConstraint("page_id", "granularity", "bucket_start", name="uq_publish_stats_bucket"),
+        Index("ix_publish_stats_granularity_bucket", "granularity", "bucket_start"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    page_id = Column(String)
+    granularity = Column(String)
+    bucket_start = Column(DateTime)
+    publishes = Column(Integer, default=0)
+    failures = Column(Integer, default=0)
+    images = Column(Integer, default=0)
+
+
+class PostMetric(Base):
+    """
+    Bảng post_metrics: số liệu tương tác của bài đã đăng (đọc từ Graph API bởi job nền)
+    - reactions, comments, shares, reach (reach = post_impressions_unique, cần quyền read_insights)
+    - fetched_at: lần lấy gần nhất; next_refresh_at: lần lấy tiếp theo (NULL = ngừng theo dõi)
+    """
+    __tablename__ = "post_metrics"
+
+    id = Column(Integer, primary_key=True, index=True)
+    post_id = Column(Integer, unique=True, index=True)
+    facebook_post_id = Column(String)
+    reactions = Column(Integer, nullable=True)
+    comments = Column(Integer, nullable=True)
+    shares = Column(Integer, nullable=True)
+    reach = Column(Integer, nullable=True)
+    fetched_at = Column(DateTime, nullable=True)
+    next_refresh_at = Column(DateTime, nullable=True, index=True)
+    last_error = Column(Text, nullable=True)
+
+
+class IdempotencyKey(Base):
+    """
+    Bảng idempotency_keys: header Idempotency-Key của POST /posts/create-and-publish
+    - (user_id, key) duy nhất -> client gửi lại cùng key nhận lại đúng job cũ, không tạo bài mới
+    - request_hash: sha256 của body; cùng key nhưng body khác -> từ chối (422)
+    - post_id: bài (job) đã tạo cho key này
+    Key cũ hơn IDEMPOTENCY_KEY_TTL_HOURS được job cleanup_idempotency_keys xóa.
+    """
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        UniqueConstraint("user_id", "key", name="uq_idempotency_keys_user_key"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer)
+    key = Column(String)
+    request_hash = Column(String)
+    post_id = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+def add_missing_columns(conn, tables):
+    """ALTER TABLE ... ADD COLUMN cho các cột có trong model nhưng chưa có trong DB."""
+    inspector = inspect(conn)
+    for table in tables:
+        existing = {col["name"] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                print(f"MIGRATE: thêm cột {table.name}.{column.name}")
+
+
+def _rebuild_posts_autoincrement(conn):
+    """
+    SQLite: bảng posts tạo trước khi có AUTOINCREMENT sẽ cấp lại id lớn nhất đã bị xóa
+    -> bài mới trùng id với bài trong archive. Dựng lại bảng (giữ nguyên id); index được
+    migrate_schema tạo lại ngay sau đó, trigger FTS được init_search_index tạo lại.
+    """
+    table_sql = conn.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'posts'"
+    )).scalar()
+    if not table_sql or "AUTOINCREMENT" in table_sql.upper():
+        return
+    columns = ", ".join(column.name for column in Post.__table__.columns)
+    create_sql = str(CreateTable(Post.__table__).compile(dialect=engine.dialect))
+    conn.execute(text(create_sql.replace("CREATE TABLE posts", "CREATE TABLE posts_rebuild", 1)))
+    conn.execute(text(f"INSERT INTO posts_rebuild ({columns}) SELECT {columns} FROM posts"))
+    conn.execute(text("DROP TABLE posts"))
+    conn.execute(text("ALTER TABLE posts_rebuild RENAME TO posts"))
+    print("MIGRATE: dựng lại bảng posts với AUTOINCREMENT")
+
+
+def _archived_max_post_id() -> int:
+    archive_db = get_archive_session()
+    if archive_db is None:
+        return 0
+    try:
+        return archive_db.query(func.max(ARCHIVED_TABLES["posts"].c.id)).scalar() or 0
+    finally:
+        archive_db.close()
+
+
+def migrate_schema():
+    """
+    create_all chỉ tạo bảng mới, không thêm cột vào bảng đã có.
+    Hàm này bổ sung các cột / index còn thiếu cho DB cũ và điền giá trị cho dữ liệu cũ.
+    """
+    # Đọc trước khi mở transaction migrate (archive có thể nằm cùng file SQLite)
+    archived_max_id = _archived_max_post_id()
+    with engine.begin() as conn:
+        add_missing_columns(conn, Base.metadata.sorted_tables)
+        # Sau khi đủ cột, trước khi tạo index (DROP TABLE xóa luôn index của posts cũ)
+        if engine.dialect.name == "sqlite":
+            _rebuild_posts_autoincrement(conn)
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+        # Bài cũ chưa có status: suy ra từ cột posted.
+        # Bài chưa đăng mà đã quá giờ hẹn (job APScheduler trong RAM mất khi restart / lỗi không
+        # ghi lại) -> failed chứ không pending, để dispatcher không đăng dồn cả loạt bài cũ ngay
+        # khi deploy; người vận hành chủ động đưa lại qua POST /failed-posts/redrive.
+        conn.execute(text(
+            "UPDATE posts SET status = :failed, last_error = :reason "
+            "WHERE status IS NULL AND (posted IS NULL OR NOT posted) "
+            "AND (scheduled_time IS NULL OR scheduled_time <= :now)"
+        ), {
+            "failed": PostStatus.FAILED,
+            "reason": "Legacy post past its scheduled time when the publish queue was introduced; "
+                      "not published automatically. Use POST /failed-posts/redrive to publish it.",
+            "now": datetime.utcnow(),
+        })
+        conn.execute(text(
+            "UPDATE posts SET status = CASE WHEN posted THEN :posted ELSE :pending END "
+            "WHERE status IS NULL"
+        ), {"posted": PostStatus.POSTED, "pending": PostStatus.PENDING})
+        conn.execute(text("UPDATE posts SET attempt_count = 0 WHERE attempt_count IS NULL"))
+        conn.execute(text(
+            "UPDATE posts SET next_attempt_at = scheduled_time "
+            "WHERE status = :pending AND next_attempt_at IS NULL"
+        ), {"pending": PostStatus.PENDING})
+
+        # id bài mới phải lớn hơn mọi id đã nằm trong archive
+        if engine.dialect.name == "sqlite" and archived_max_id:
+            updated = conn.execute(text(
+                "UPDATE sqlite_sequence SET seq = :floor WHERE name = 'posts' AND seq < :floor"
+            ), {"floor": archived_max_id}).rowcount
+            if not updated and conn.execute(text(
+                "SELECT 1 FROM sqlite_sequence WHERE name = 'posts'"
+            )).first() is None:
+                conn.execute(text(
+                    "INSERT INTO sqlite_sequence (name, seq) VALUES ('posts', :floor)"
+                ), {"floor": archived_max_id})
+
+
+def init_db():
+    """
+    Chuẩn bị storage khi app khởi động (gọi trong lifespan, không chạy lúc import):
+    - tạo bảng nếu chưa có (chỉ tạo cấu trúc DB) + bổ sung cột mới cho DB cũ
+    - tạo index full-text cho posts.content
+    - tạo thư mục upload
+    """
+    Base.metadata.create_all(bind=engine)
+    migrate_schema()
+    init_search_index()
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # ------------------------------
 # Pydantic models (request/response)
@@ -280,16 +639,47 @@ class PostImageResponse(BaseModel):
     facebook_photo_id: Optional[str]
     created_at: datetime
 
+class PostVideoCreate(BaseModel):
+    """
+    Schema video kèm post:
+    - video_path: file_path trả về từ /upload-video/
+    """
+    video_path: str
+
+class PostVideoResponse(BaseModel):
+    """
+    Schema trả về thông tin video
+    - start_offset / file_size: tiến độ upload lên Facebook
+    """
+    id: int
+    post_id: int
+    video_path: Optional[str]
+    file_size: Optional[int]
+    facebook_video_id: Optional[str]
+    start_offset: Optional[int]
+    created_at: datetime
+
 class PostCreate(BaseModel):
     """
     Schema khi tạo bài:
     - content: nội dung bài
     - scheduled_time: thời gian dự định đăng (datetime)
     - images: danh sách ảnh (PostImageCreate)
+    - videos: tối đa 1 video (PostVideoCreate); bài có video thì không kèm ảnh
     """
     content: str
     scheduled_time: datetime
     images: List[PostImageCreate] = []
+    videos: List[PostVideoCreate] = []
+
+class PostPublishRequest(BaseModel):
+    """
+    Schema tạo + đăng ngay (POST /posts/create-and-publish): như PostCreate nhưng không có
+    scheduled_time (bài đến hạn ngay khi tạo)
+    """
+    content: str
+    images: List[PostImageCreate] = []
+    videos: List[PostVideoCreate] = []
 
 class PostResponse(BaseModel):
     """
@@ -303,7 +693,19 @@ class PostResponse(BaseModel):
     facebook_post_id: Optional[str]
     created_at: datetime
     posted_at: Optional[datetime]
+    status: Optional[str] = None
+    attempt_count: Optional[int] = 0
+    last_error: Optional[str] = None
+    next_attempt_at: Optional[datetime] = None
     images: List[PostImageResponse] = []
+    videos: List[PostVideoResponse] = []
+
+class RedriveRequest(BaseModel):
+    """
+    Schema re-drive bài dead-letter:
+    - post_ids: danh sách id cần đăng lại; bỏ trống = tất cả bài đang failed
+    """
+    post_ids: Optional[List[int]] = None
 
 class FacebookTokenCreate(BaseModel):
     """
@@ -327,14 +729,286 @@ class FacebookTokenResponse(BaseModel):
     expires_at: Optional[datetime]
     created_at: datetime
 
+# ------------------------------
+# FAST SERIALIZATION (list endpoints)
+# ------------------------------
+# Với trang lớn (hàng trăm / hàng nghìn post), validate từng ORM object qua
+# PostResponse rồi encode bằng json chuẩn tốn nhiều CPU. Đường nhanh dưới đây
+# query thẳng các cột cần thiết, dựng dict gọn rồi encode bằng orjson (nếu có).
+# Cấu trúc JSON giữ y hệt PostResponse / PostImageResponse.
+
+POST_COLUMNS = (
+    Post.id, Post.content, Post.scheduled_time, Post.posted,
+    Post.facebook_post_id, Post.created_at, Post.posted_at,
+    Post.status, Post.attempt_count, Post.last_error, Post.next_attempt_at,
+)
+POST_IMAGE_COLUMNS = (
+    PostImage.id, PostImage.post_id, PostImage.image_url, PostImage.image_path,
+    PostImage.facebook_photo_id, PostImage.created_at,
+)
+POST_VIDEO_COLUMNS = (
+    PostVideo.id, PostVideo.post_id, PostVideo.video_path, PostVideo.file_size,
+    PostVideo.facebook_video_id, PostVideo.start_offset, PostVideo.created_at,
+)
+
+# SQLite cũ giới hạn 999 tham số / câu lệnh -> chia nhỏ mệnh đề IN
+IN_CLAUSE_CHUNK = 500
+
+
+def _json_default(value):
+    """Fallback cho json chuẩn: datetime -> ISO 8601 (giống output của Pydantic)."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps_json(data) -> bytes:
+    """Encode JSON gọn (không khoảng trắng), ưu tiên orjson."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(
+        data, default=_json_default, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    """JSONResponse dùng dumps_json (orjson nếu có)."""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps_json(content)
+
+
+def serialize_posts(db: Session, post_rows, archived: bool = False) -> List[dict]:
+    """
+    Dựng list dict cho các post (rows từ query(*POST_COLUMNS)):
+    - ảnh / video của cả trang được lấy bằng 1 query IN (thay vì 1 query / post)
+    - thứ tự post giữ nguyên theo post_rows
+    - archived=True: db là session của DB archive, đọc ảnh / video từ bảng archived_*
+    """
+    if archived:
+        image_columns, video_columns = ARCHIVE_IMAGE_COLUMNS, ARCHIVE_VIDEO_COLUMNS
+    else:
+        image_columns, video_columns = POST_IMAGE_COLUMNS, POST_VIDEO_COLUMNS
+    # Cột 0 là id, cột 1 là post_id (xem POST_IMAGE_COLUMNS / POST_VIDEO_COLUMNS)
+    image_id, image_post_id = image_columns[0], image_columns[1]
+    video_id, video_post_id = video_columns[0], video_columns[1]
+    posts = []
+    by_id = {}
+    for row in post_rows:
+        item = dict(row._mapping)
+        item["images"] = []
+        item["videos"] = []
+        posts.append(item)
+        by_id[item["id"]] = item
+
+    ids = list(by_id)
+    for start in range(0, len(ids), IN_CLAUSE_CHUNK):
+        chunk = ids[start:start + IN_CLAUSE_CHUNK]
+        image_rows = (
+            db.query(*image_columns)
+            .filter(image_post_id.in_(chunk))
+            .order_by(image_id)
+            .all()
+        )
+        for image in image_rows:
+            by_id[image.post_id]["images"].append(dict(image._mapping))
+        video_rows = (
+            db.query(*video_columns)
+            .filter(video_post_id.in_(chunk))
+            .order_by(video_id)
+            .all()
+        )
+        for video in video_rows:
+            by_id[video.post_id]["videos"].append(dict(video._mapping))
+
+    return posts
+
 # ------------------------------
 # FASTAPI APP SETUP
 # ------------------------------
-app = FastAPI(title="AutoFB API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Khởi động / tắt app:
+    - init_db (tạo bảng, migrate, thư mục upload)
+    - start scheduler nếu process này được cấu hình chạy scheduler
+    - in báo cáo thời gian khởi động
+    """
+    report = [("import main.py", _LIFESPAN_READY - _IMPORT_STARTED)]
+
+    step_started = time.perf_counter()
+    init_db()
+    report.append(("init_db", time.perf_counter() - step_started))
+
+    step_started = time.perf_counter()
+    scheduler_started = start_scheduler_if_configured()
+    report.append((f"scheduler ({'chạy' if scheduler_started else 'không chạy'})", time.perf_counter() - step_started))
+
+    total = time.perf_counter() - _IMPORT_STARTED
+    print("STARTUP: " + ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in report)
+          + f" | tổng {total * 1000:.0f}ms (pid {os.getpid()})")
+
+    yield
+
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+
+
+app = FastAPI(title="AutoFB API", version="1.0.0", lifespan=lifespan)
 
-# Mount static files: cho phép truy cập trực tiếp ảnh đã upload qua URL /uploads/<filename>
+# Ảnh đã upload được phục vụ qua route /uploads/<filename> (xem phần SERVE UPLOADS bên dưới)
 # Ví dụ: http://localhost:8000/uploads/abcd.jpg
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+
+# ------------------------------
+# Admission control (giới hạn đồng thời theo nhóm endpoint nặng)
+# ------------------------------
+# Mỗi nhóm endpoint tốn tài nguyên (gọi Gemini, ghi file lớn, gọi Facebook, export dài) có
+# giới hạn số request chạy đồng thời + hàng đợi ngắn. Hàng đợi đầy hoặc chờ quá
+# ADMISSION_QUEUE_TIMEOUT_SECONDS -> trả 429 + Retry-After ngay, để các request nặng không
+# chiếm hết threadpool và các request rẻ (GET /posts/...) vẫn được phục vụ.
+# Giới hạn tính theo từng process (mỗi worker uvicorn / gunicorn có bộ đếm riêng).
+# Ghi đè bằng ADMISSION_LIMITS dạng "nhóm=đồng_thời:hàng_đợi,...", vd "ai=2:4,upload=8:16".
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", 10))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", 5))
+
+# nhóm -> (method, regex path)
+ADMISSION_ROUTES = {
+    "ai": [("POST", re.compile(r"^/generate-content/?$"))],
+    "upload": [("POST", re.compile(r"^/upload-(image|multiple-images|video)/?$"))],
+    # create-and-publish: khi worker không chạy scheduler, việc đăng chạy bằng BackgroundTasks
+    # (sau khi gửi 202 nhưng vẫn trong request) -> slot được giữ tới khi đăng xong
+    "publish": [
+        ("POST", re.compile(r"^/posts/\d+/post-now/?$")),
+        ("POST", re.compile(r"^/posts/create-and-publish/?$")),
+    ],
+    "export": [("GET", re.compile(r"^/export/posts/?$"))],
+}
+# nhóm -> (số request đồng thời, số request được xếp hàng)
+ADMISSION_DEFAULT_LIMITS = {
+    "ai": (4, 8),
+    "upload": (4, 16),
+    "publish": (4, 8),
+    "export": (2, 2),
+}
+
+
+def _parse_admission_limits(raw: str) -> dict:
+    limits = dict(ADMISSION_DEFAULT_LIMITS)
+    for part in raw.split(","):
+        if not part.strip():
+            continue
+        try:
+            name, values = part.split("=")
+            concurrency, queue = values.split(":")
+            limits[name.strip()] = (max(1, int(concurrency)), max(0, int(queue)))
+        except ValueError:
+            print(f"CẢNH BÁO: bỏ qua giá trị ADMISSION_LIMITS không hợp lệ: {part!r}")
+    return limits
+
+
+ADMISSION_LIMITS = _parse_admission_limits(os.getenv("ADMISSION_LIMITS", ""))
+
+
+class _AdmissionGate:
+    """Giới hạn đồng thời + hàng đợi có giới hạn cho 1 nhóm endpoint (chạy trong event loop)."""
+
+    def __init__(self, name: str, concurrency: int, queue_size: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self._semaphore = None
+
+    async def acquire(self) -> bool:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        if self._semaphore.locked():
+            if self.waiting >= self.queue_size:
+                self.rejected_queue_full += 1
+                return False
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=ADMISSION_QUEUE_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                self.rejected_timeout += 1
+                return False
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    def snapshot(self) -> dict:
+        return {
+            "concurrency_limit": self.concurrency,
+            "queue_limit": self.queue_size,
+            "active": self.active,
+            "queued": self.waiting,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+        }
+
+
+admission_gates = {
+    name: _AdmissionGate(name, *ADMISSION_LIMITS.get(name, ADMISSION_DEFAULT_LIMITS[name]))
+    for name in ADMISSION_ROUTES
+}
+
+
+class AdmissionControlMiddleware:
+    """
+    ASGI middleware: request thuộc nhóm trong ADMISSION_ROUTES phải lấy được slot của nhóm
+    (giữ tới khi response gửi xong, kể cả response streaming), nếu không -> 429 + Retry-After.
+    Request khác đi thẳng.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def _gate_for(scope) -> Optional[_AdmissionGate]:
+        method, path = scope["method"], scope["path"]
+        for name, routes in ADMISSION_ROUTES.items():
+            for route_method, pattern in routes:
+                if method == route_method and pattern.match(path):
+                    return admission_gates[name]
+        return None
+
+    async def __call__(self, scope, receive, send):
+        gate = self._gate_for(scope) if scope["type"] == "http" else None
+        if gate is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await gate.acquire():
+            response = FastJSONResponse(
+                {"detail": f"Server is busy ({gate.name}), please retry later."},
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={"Retry-After": str(ADMISSION_RETRY_AFTER_SECONDS)},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.release()
+
+
+# Thêm trước CORS để nằm bên trong CORS middleware: response 429 vẫn có header CORS
+# và frontend đọc được
+app.add_middleware(AdmissionControlMiddleware)
 
 # CORS middleware: cho phép frontend (ví dụ React dev server) gọi API
 # Nếu deploy production, hãy chỉnh allow_origins phù hợp hoặc dùng env var
@@ -346,6 +1020,137 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ------------------------------
+# Response compression (gzip / brotli)
+# ------------------------------
+# Nén response lớn hơn COMPRESS_MIN_SIZE byte. Ưu tiên brotli nếu client hỗ trợ
+# và đã cài package `brotli`, ngược lại dùng gzip. Hỗ trợ cả streaming response.
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", 5))
+
+# Chỉ nén các loại nội dung dạng text (ảnh / video đã nén sẵn)
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+
+class _GzipEncoder:
+    encoding = "gzip"
+
+    def __init__(self):
+        # wbits=31 -> định dạng gzip (header + trailer)
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+class _BrotliEncoder:
+    encoding = "br"
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.process(data) + self._compressor.finish()
+
+
+def _choose_encoder(accept_encoding: str):
+    accepted = {part.split(";")[0].strip().lower() for part in accept_encoding.split(",")}
+    if brotli is not None and "br" in accepted:
+        return _BrotliEncoder
+    if "gzip" in accepted:
+        return _GzipEncoder
+    return None
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware nén response (tương tự starlette GZipMiddleware nhưng có brotli):
+    - bỏ qua response nhỏ hơn minimum_size, response đã có Content-Encoding,
+      response 206 và các content-type không nằm trong COMPRESSIBLE_TYPES
+    - response streaming được nén từng chunk (flush sau mỗi chunk)
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        encoder_cls = _choose_encoder(request_headers.get("accept-encoding", ""))
+        if encoder_cls is None:
+            await self.app(scope, receive, send)
+            return
+
+        state = {"start": None, "encoder": None, "passthrough": False}
+
+        async def send_compressed(message):
+            if message["type"] == "http.response.start":
+                # Giữ lại message start cho tới khi biết có nén hay không
+                state["start"] = message
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "")
+                state["passthrough"] = (
+                    "content-encoding" in headers
+                    or message["status"] == 206
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)
+                )
+                return
+
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            start = state["start"]
+
+            if start is not None:
+                # Chunk body đầu tiên: quyết định nén hay không
+                state["start"] = None
+                if state["passthrough"] or (not more_body and len(body) < self.minimum_size):
+                    state["passthrough"] = True
+                    await send(start)
+                    await send(message)
+                    return
+
+                encoder = state["encoder"] = encoder_cls()
+                headers = MutableHeaders(raw=start["headers"])
+                headers["Content-Encoding"] = encoder.encoding
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    del headers["Content-Length"]
+                    body = encoder.compress(body)
+                else:
+                    body = encoder.finish(body)
+                    headers["Content-Length"] = str(len(body))
+                await send(start)
+                await send({"type": "http.response.body", "body": body, "more_body": more_body})
+                return
+
+            if state["passthrough"]:
+                await send(message)
+                return
+
+            encoder = state["encoder"]
+            body = encoder.compress(body) if more_body else encoder.finish(body)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESS_MIN_SIZE)
+
 # Security placeholder (file gốc khai báo nhưng chưa dùng)
 security = HTTPBearer()
 
@@ -363,6 +1168,19 @@ def get_db():
     finally:
         db.close()
 
+# ------------------------------
+# Dependency: tenant (user) của request
+# ------------------------------
+DEFAULT_USER_ID = 1
+
+
+def get_current_user_id(x_user_id: Optional[int] = Header(None)) -> int:
+    """
+    Tenant của request lấy từ header X-User-Id (tạm thời, cho tới khi có auth thật).
+    Không gửi header -> user 1 như bản demo cũ, frontend hiện tại không cần sửa.
+    """
+    return x_user_id if x_user_id is not None else DEFAULT_USER_ID
+
 # ------------------------------
 # Facebook Graph API helper
 # ------------------------------
@@ -370,7 +1188,10 @@ class FacebookAPI:
     """
     Lớp helper chứa các static methods gọi Facebook Graph API:
     - upload_photo: upload 1 ảnh (published hoặc unpublished tuỳ param)
+    - upload_unpublished_photo: upload 1 ảnh unpublished để lấy media_fbid (đăng album / pre-stage)
+    - delete_object: xóa 1 object (vd. ảnh unpublished không còn dùng)
     - post_to_facebook_with_images: logic đăng text / 1 ảnh / nhiều ảnh
+    - post_video_resumable: đăng video bằng resumable upload (gửi từng đoạn, tiếp tục được)
     - get_page_info: verify token + lấy tên page
     """
 
@@ -381,7 +1202,8 @@ class FacebookAPI:
         Trả về JSON nếu ok, ngược lại raise HTTPException.
         """
         url = f"https://graph.facebook.com/v18.0/{page_id}/photos"
-        
+        image_path = media_local_path(image_path) or image_path
+
         with open(image_path, 'rb') as image_file:
             files = {'source': image_file}
             data = {'access_token': access_token}
@@ -397,14 +1219,75 @@ class FacebookAPI:
             raise HTTPException(status_code=400, detail=f"Facebook photo upload error: {response.text}")
     
     @staticmethod
-    def post_to_facebook_with_images(access_token: str, page_id: str, content: str, images: List[dict]):
+    def upload_unpublished_photo(access_token: str, page_id: str, image: dict) -> Optional[str]:
+        """
+        Upload 1 ảnh với published=false: FB trả media id nhưng không hiển thị riêng lẻ,
+        id này dùng trong attached_media của /feed.
+        Trả về photo id; entry không hợp lệ -> None; lỗi Facebook -> HTTPException.
+        """
+        url = f"https://graph.facebook.com/v18.0/{page_id}/photos"
+        # File upload: đọc qua storage (S3 -> cache đọc-qua trên disk local)
+        image_path = media_local_path(image.get('image_path'))
+        if image_path:
+            with open(image_path, 'rb') as image_file:
+                files = {'source': image_file}
+                data = {
+                    'published': 'false',  # unpublished: FB sẽ trả media id nhưng không hiển thị riêng lẻ
+                    'access_token': access_token
+                }
+                response = requests.post(url, files=files, data=data)
+        elif image.get('image_url'):
+            data = {
+                "url": image['image_url'],
+                "published": "false",  # unpublished
+                "access_token": access_token
+            }
+            response = requests.post(url, data=data)
+        else:
+            # Nếu entry không hợp lệ, bỏ qua
+            print(f"Skipping invalid image: {image}")
+            return None
+
+        if response.status_code != 200:
+            print(f"Failed to upload photo: {response.text}")
+            raise HTTPException(status_code=400, detail=f"Facebook photo upload error: {response.text}")
+        photo_id = response.json().get("id")
+        if not photo_id:
+            # FB không trả id? log để debug
+            print(f"No photo ID in response: {response.json()}")
+        return photo_id
+
+    @staticmethod
+    def delete_object(access_token: str, object_id: str) -> bool:
+        """Xóa 1 object Graph (best-effort, không raise): trả True nếu Facebook xác nhận đã xóa."""
+        try:
+            response = requests.delete(
+                f"https://graph.facebook.com/v18.0/{object_id}",
+                params={"access_token": access_token},
+                timeout=30,
+            )
+        except requests.RequestException as e:
+            print(f"Facebook delete error ({object_id}): {e}")
+            return False
+        if response.status_code != 200:
+            print(f"Facebook delete error ({object_id}): {response.text}")
+            return False
+        return True
+
+    @staticmethod
+    def post_to_facebook_with_images(access_token: str, page_id: str, content: str, images: List[dict],
+                                     on_photo_uploaded=None):
         """
         Hàm này xử lý 3 trường hợp:
         1) Không có images => đăng text-only lên /{page_id}/feed
-        2) 1 ảnh => dùng /{page_id}/photos với published=true (ảnh có kèm message)
+        2) 1 ảnh => dùng /{page_id}/photos với published=true (ảnh có kèm message);
+           nếu ảnh đã được pre-stage (có facebook_photo_id) thì chỉ gọi /feed với attached_media
         3) Nhiều ảnh => từng ảnh upload với published=false (để lấy media_fbid),
            sau đó gọi /{page_id}/feed với attached_media=[{"media_fbid":id}, ...]
-        images: list of dict { 'image_path': <local path> OR 'image_url': <external url> }
+        images: list of dict { 'image_path': <local path> OR 'image_url': <external url>,
+                               'facebook_photo_id': <id nếu ảnh đã upload ở lần trước> }
+        on_photo_uploaded(image, photo_id): callback gọi ngay sau mỗi ảnh unpublished upload
+        thành công (dùng để lưu checkpoint). Ảnh đã có facebook_photo_id sẽ không upload lại.
         """
         # ---------- case: text only ----------
         if not images:
@@ -427,12 +1310,13 @@ class FacebookAPI:
                 raise HTTPException(status_code=400, detail=f"Facebook API error: {response.text}")
         
         # ---------- case: single image ----------
-        elif len(images) == 1:
+        elif len(images) == 1 and not images[0].get('facebook_photo_id'):
             image = images[0]
-            # Nếu có file local -> upload file kèm message
-            if image.get('image_path') and os.path.exists(image['image_path']):
+            # Nếu có file upload -> upload file kèm message
+            image_path = media_local_path(image.get('image_path'))
+            if image_path:
                 url = f"https://graph.facebook.com/v18.0/{page_id}/photos"
-                with open(image['image_path'], 'rb') as image_file:
+                with open(image_path, 'rb') as image_file:
                     files = {'source': image_file}
                     data = {
                         'message': content,
@@ -466,46 +1350,27 @@ class FacebookAPI:
                 print(f"Facebook Single Photo Error: {response.text}")
                 raise HTTPException(status_code=400, detail=f"Facebook photo upload error: {response.text}")
         
-        # ---------- case: multiple images ----------
+        # ---------- case: multiple images (hoặc ảnh đã pre-stage) ----------
         else:
             uploaded_media = []
             
             # Step 1: upload each photo as unpublished để chỉ lấy media_fbid
             for image in images:
-                if image.get('image_path') and os.path.exists(image['image_path']):
-                    url = f"https://graph.facebook.com/v18.0/{page_id}/photos"
-                    with open(image['image_path'], 'rb') as image_file:
-                        files = {'source': image_file}
-                        data = {
-                            'published': 'false',  # unpublished: FB sẽ trả media id nhưng không hiển thị riêng lẻ
-                            'access_token': access_token
-                        }
-                        response = requests.post(url, files=files, data=data)
-                elif image.get('image_url'):
-                    url = f"https://graph.facebook.com/v18.0/{page_id}/photos"
-                    data = {
-                        "url": image['image_url'],
-                        "published": "false",  # unpublished
-                        "access_token": access_token
-                    }
-                    response = requests.post(url, data=data)
-                else:
-                    # Nếu entry không hợp lệ, bỏ qua
-                    print(f"Skipping invalid image: {image}")
+                # Ảnh đã upload thành công ở lần thử trước -> dùng lại id, không upload lại
+                if image.get('facebook_photo_id'):
+                    uploaded_media.append({"media_fbid": image['facebook_photo_id']})
+                    print(f"Reusing uploaded photo: {image['facebook_photo_id']}")
                     continue
-                
-                if response.status_code == 200:
-                    photo_id = response.json().get("id")
-                    if photo_id:
-                        uploaded_media.append({"media_fbid": photo_id})
-                        print(f"Successfully uploaded photo: {photo_id}")
-                    else:
-                        # FB không trả id? log để debug
-                        print(f"No photo ID in response: {response.json()}")
-                else:
-                    # Nếu 1 ảnh fail -> throw lỗi tổng thể
-                    print(f"Failed to upload photo: {response.text}")
-                    raise HTTPException(status_code=400, detail=f"Facebook photo upload error: {response.text}")
+
+                # Nếu 1 ảnh fail -> raise lỗi tổng thể
+                # (các ảnh trước đó đã được checkpoint, lần retry sẽ tiếp tục từ ảnh này)
+                photo_id = FacebookAPI.upload_unpublished_photo(access_token, page_id, image)
+                if photo_id:
+                    image['facebook_photo_id'] = photo_id
+                    uploaded_media.append({"media_fbid": photo_id})
+                    print(f"Successfully uploaded photo: {photo_id}")
+                    if on_photo_uploaded:
+                        on_photo_uploaded(image, photo_id)
             
             # Step 2: nếu có uploaded_media -> tạo post trên /feed attach media
             if uploaded_media:
@@ -531,6 +1396,93 @@ class FacebookAPI:
                 # Không upload được ảnh nào
                 raise HTTPException(status_code=400, detail="No photos uploaded successfully")
     
+    @staticmethod
+    def post_video_resumable(access_token: str, page_id: str, content: str, video: dict,
+                             on_progress=None):
+        """
+        Đăng 1 video theo 3 phase của Facebook (graph-video.facebook.com/{page_id}/videos):
+        1) start: báo file_size, nhận upload_session_id, video_id và đoạn đầu tiên (start/end offset)
+        2) transfer: gửi đúng đoạn [start_offset, end_offset) đọc từ disk, Facebook trả đoạn kế tiếp;
+           hết file khi start_offset == end_offset
+        3) finish: đăng video với description = content
+        video: dict { 'video_path', 'upload_session_id', 'facebook_video_id', 'start_offset', 'end_offset' }
+        Nếu dict đã có upload_session_id (lần trước lỗi giữa chừng) thì bỏ qua start và gửi
+        tiếp từ start_offset. on_progress(video) được gọi sau mỗi phase / đoạn thành công
+        (dùng để lưu checkpoint).
+        """
+        url = f"https://graph-video.facebook.com/v18.0/{page_id}/videos"
+        video_path = media_local_path(video.get('video_path'))
+        if not video_path:
+            raise HTTPException(status_code=400, detail="No valid video provided")
+
+        # ---------- phase: start ----------
+        if not video.get('upload_session_id'):
+            file_size = os.path.getsize(video_path)
+            data = {
+                'upload_phase': 'start',
+                'file_size': file_size,
+                'access_token': access_token
+            }
+            response = requests.post(url, data=data, timeout=VIDEO_REQUEST_TIMEOUT_SECONDS)
+            if response.status_code != 200:
+                print(f"Facebook Video Start Error: {response.text}")
+                raise HTTPException(status_code=400, detail=f"Facebook video upload error: {response.text}")
+            result = response.json()
+            video.update({
+                'file_size': file_size,
+                'upload_session_id': result.get('upload_session_id'),
+                'facebook_video_id': result.get('video_id'),
+                'start_offset': int(result.get('start_offset', 0)),
+                'end_offset': int(result.get('end_offset', 0)),
+                'upload_started_at': datetime.utcnow(),
+            })
+            print(f"Started video upload session: {video['upload_session_id']}")
+            if on_progress:
+                on_progress(video)
+
+        # ---------- phase: transfer ----------
+        # Mỗi lần chỉ đọc 1 đoạn (kích thước do Facebook quyết định) vào bộ nhớ
+        with open(video_path, 'rb') as video_file:
+            while video['start_offset'] < video['end_offset']:
+                start_offset = video['start_offset']
+                video_file.seek(start_offset)
+                chunk = video_file.read(video['end_offset'] - start_offset)
+                data = {
+                    'upload_phase': 'transfer',
+                    'upload_session_id': video['upload_session_id'],
+                    'start_offset': start_offset,
+                    'access_token': access_token
+                }
+                files = {'video_file_chunk': (os.path.basename(video_path), chunk, 'application/octet-stream')}
+                response = requests.post(url, data=data, files=files, timeout=VIDEO_REQUEST_TIMEOUT_SECONDS)
+                if response.status_code != 200:
+                    # Các đoạn trước đã được checkpoint, lần retry gửi tiếp từ start_offset
+                    print(f"Facebook Video Transfer Error at offset {start_offset}: {response.text}")
+                    raise HTTPException(status_code=400, detail=f"Facebook video upload error: {response.text}")
+                result = response.json()
+                video['start_offset'] = int(result.get('start_offset', video['end_offset']))
+                video['end_offset'] = int(result.get('end_offset', video['start_offset']))
+                if on_progress:
+                    on_progress(video)
+
+        # ---------- phase: finish ----------
+        data = {
+            'upload_phase': 'finish',
+            'upload_session_id': video['upload_session_id'],
+            'description': content,
+            'access_token': access_token
+        }
+        response = requests.post(url, data=data, timeout=VIDEO_REQUEST_TIMEOUT_SECONDS)
+        if response.status_code != 200 or not response.json().get('success', True):
+            print(f"Facebook Video Finish Error: {response.text}")
+            raise HTTPException(status_code=400, detail=f"Facebook video publish error: {response.text}")
+        result = response.json()
+        return {
+            "post_id": video['facebook_video_id'],
+            "uploaded_media": [{"video_id": video['facebook_video_id']}],
+            "facebook_response": result
+        }
+
     @staticmethod
     def get_page_info(access_token: str, page_id: str):
         """
@@ -556,78 +1508,1565 @@ class FacebookAPI:
 # Dùng BackgroundScheduler để schedule các job chạy ở background
 # Lưu ý: BackgroundScheduler mặc định lưu job ở memory -> nếu server restart, job mất.
 # Để bền hơn, cần dùng jobstore (ví dụ SQLite jobstore hoặc Redis).
+# Scheduler chỉ được start trong lifespan và chỉ ở process được cấu hình:
+# - RUN_SCHEDULER=0: process này không chạy job nền (ví dụ các worker web)
+# - RUN_SCHEDULER=1 (mặc định): chạy, nhưng giữ file lock SCHEDULER_LOCK_FILE để khi
+#   gunicorn fork nhiều worker thì chỉ 1 worker chạy scheduler
 scheduler = BackgroundScheduler()
-scheduler.start()
+SCHEDULER_LOCK_FILE = os.getenv("SCHEDULER_LOCK_FILE", "autofb-scheduler.lock")
+_scheduler_lock_handle = None
 
-def post_scheduled_content(post_id: int):
-    """
-    Hàm worker do APScheduler gọi khi tới thời gian scheduled_time.
+
+def start_scheduler_if_configured() -> bool:
+    global _scheduler_lock_handle
+    if os.getenv("RUN_SCHEDULER", "1").lower() in ("0", "false", "no"):
+        return False
+
+    if SCHEDULER_LOCK_FILE:
+        try:
+            import fcntl
+        except ImportError:
+            # Windows: không có fcntl -> bỏ qua lock
+            fcntl = None
+        if fcntl is not None:
+            lock_handle = open(SCHEDULER_LOCK_FILE, "w")
+            try:
+                fcntl.flock(lock_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_handle.close()
+                print(f"Scheduler đã chạy ở process khác (lock {SCHEDULER_LOCK_FILE}), bỏ qua.")
+                return False
+            _scheduler_lock_handle = lock_handle
+
+    scheduler.start()
+    return True
+
+def staged_photo_is_stale(image: dict, page_id: Optional[str], now: datetime) -> bool:
+    """
+    Ảnh đã upload (pre-stage / checkpoint) nhưng không dùng lại được: upload cho page khác
+    hoặc đã quá PRESTAGE_MAX_AGE_HOURS. Ảnh checkpoint cũ (chưa lưu page / thời gian) coi như còn dùng được.
+    """
+    if not image.get('facebook_photo_id'):
+        return False
+    if page_id and image.get('facebook_page_id') and image['facebook_page_id'] != page_id:
+        return True
+    uploaded_at = image.get('facebook_photo_uploaded_at')
+    return uploaded_at is not None and uploaded_at < now - timedelta(hours=PRESTAGE_MAX_AGE_HOURS)
+
+
+def load_post_images(db: Session, post_id: int, page_id: Optional[str] = None) -> List[dict]:
+    """
+    Lấy ảnh kèm post dưới dạng list dict cho FacebookAPI (kèm id + facebook_photo_id đã lưu).
+    Có page_id: bỏ facebook_photo_id đã cũ (staged_photo_is_stale) để ảnh được upload lại.
+    """
+    images = db.query(PostImage).filter(PostImage.post_id == post_id).order_by(PostImage.id).all()
+    now = datetime.utcnow()
+    result = []
+    for img in images:
+        item = {
+            'id': img.id,
+            'image_url': img.image_url,
+            'image_path': img.image_path,
+            'facebook_photo_id': img.facebook_photo_id,
+            'facebook_photo_uploaded_at': img.facebook_photo_uploaded_at,
+            'facebook_page_id': img.facebook_page_id,
+        }
+        if page_id and staged_photo_is_stale(item, page_id, now):
+            print(f"Ảnh {img.id}: media {img.facebook_photo_id} đã cũ / khác page, upload lại.")
+            item['facebook_photo_id'] = None
+        result.append(item)
+    return result
+
+
+def photo_checkpoint(db: Session, page_id: Optional[str] = None):
+    """
+    Tạo callback on_photo_uploaded: lưu facebook_photo_id (+ page, thời điểm upload) vào
+    PostImage và commit ngay, để nếu ảnh sau bị lỗi thì lần retry bỏ qua các ảnh đã upload.
+    """
+    def _save(image: dict, photo_id: str):
+        db.query(PostImage).filter(PostImage.id == image['id']).update(
+            {
+                PostImage.facebook_photo_id: photo_id,
+                PostImage.facebook_photo_uploaded_at: datetime.utcnow(),
+                PostImage.facebook_page_id: page_id,
+            },
+            synchronize_session=False
+        )
+        db.commit()
+    return _save
+
+
+def load_post_videos(db: Session, post_id: int) -> List[dict]:
+    """
+    Lấy video kèm post dưới dạng list dict cho FacebookAPI.post_video_resumable.
+    Phiên upload đã quá hạn hoặc file đổi kích thước -> bỏ phiên cũ để upload lại từ đầu.
+    """
+    videos = db.query(PostVideo).filter(PostVideo.post_id == post_id).order_by(PostVideo.id).all()
+    session_cutoff = datetime.utcnow() - timedelta(hours=VIDEO_SESSION_MAX_AGE_HOURS)
+    result = []
+    for video in videos:
+        item = {
+            'id': video.id,
+            'video_path': video.video_path,
+            'file_size': video.file_size,
+            'upload_session_id': video.upload_session_id,
+            'facebook_video_id': video.facebook_video_id,
+            'start_offset': video.start_offset or 0,
+            'end_offset': video.end_offset or 0,
+        }
+        stale = (
+            not video.upload_started_at
+            or video.upload_started_at < session_cutoff
+            or media_size(video.video_path) != video.file_size
+        )
+        if video.upload_session_id and stale:
+            print(f"Video {video.id}: phiên upload {video.upload_session_id} hết hạn / file đổi, upload lại từ đầu.")
+            item.update({'upload_session_id': None, 'facebook_video_id': None, 'start_offset': 0, 'end_offset': 0})
+        result.append(item)
+    return result
+
+
+def video_checkpoint(db: Session, post_id: int):
+    """
+    Tạo callback on_progress cho post_video_resumable: lưu phiên + offset Facebook đã xác nhận
+    và commit ngay sau mỗi đoạn. Đồng thời gia hạn lease của bài, vì upload video lớn có thể
+    lâu hơn PUBLISH_LEASE_SECONDS (tránh dispatcher claim lại bài đang upload dở).
+    """
+    def _save(video: dict):
+        values = {
+            PostVideo.upload_session_id: video['upload_session_id'],
+            PostVideo.facebook_video_id: video['facebook_video_id'],
+            PostVideo.start_offset: video['start_offset'],
+            PostVideo.end_offset: video['end_offset'],
+            PostVideo.file_size: video['file_size'],
+        }
+        if video.get('upload_started_at'):
+            values[PostVideo.upload_started_at] = video['upload_started_at']
+        db.query(PostVideo).filter(PostVideo.id == video['id']).update(values, synchronize_session=False)
+        db.query(Post).filter(Post.id == post_id, Post.status == PostStatus.PUBLISHING).update(
+            {Post.next_attempt_at: datetime.utcnow() + timedelta(seconds=PUBLISH_LEASE_SECONDS)},
+            synchronize_session=False,
+        )
+        db.commit()
+    return _save
+
+
+# ------------------------------
+# PUBLISH STATE MACHINE (retry + dead-letter)
+# ------------------------------
+# - PUBLISH_MAX_ATTEMPTS: số lần thử tối đa trước khi chuyển sang failed (dead-letter)
+# - PUBLISH_RETRY_BASE_SECONDS / PUBLISH_RETRY_MAX_SECONDS: backoff lũy thừa 2, có jitter
+# - PUBLISH_LEASE_SECONDS: bài ở trạng thái publishing quá lâu (process chết giữa chừng)
+#   sẽ được nhận lại bởi dispatcher
+# - PUBLISH_POLL_INTERVAL_SECONDS / PUBLISH_BATCH_SIZE: chu kỳ + số bài mỗi lượt quét
+PUBLISH_MAX_ATTEMPTS = int(os.getenv("PUBLISH_MAX_ATTEMPTS", 5))
+PUBLISH_RETRY_BASE_SECONDS = float(os.getenv("PUBLISH_RETRY_BASE_SECONDS", 60))
+PUBLISH_RETRY_MAX_SECONDS = float(os.getenv("PUBLISH_RETRY_MAX_SECONDS", 3600))
+PUBLISH_LEASE_SECONDS = int(os.getenv("PUBLISH_LEASE_SECONDS", 600))
+PUBLISH_POLL_INTERVAL_SECONDS = int(os.getenv("PUBLISH_POLL_INTERVAL_SECONDS", 30))
+PUBLISH_BATCH_SIZE = int(os.getenv("PUBLISH_BATCH_SIZE", 20))
+
+
+class PublishError(Exception):
+    """Lỗi khiến bài không đăng được (không phải lỗi HTTP từ Facebook)."""
+
+
+def to_utc_naive(value: datetime) -> datetime:
+    """DB lưu datetime UTC không kèm tz: chuyển datetime có tz về UTC rồi bỏ tzinfo."""
+    if value.tzinfo is not None and value.tzinfo.utcoffset(value) is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def retry_delay_seconds(attempt: int) -> float:
+    """
+    Backoff lũy thừa có jitter ("equal jitter"): một nửa cố định, một nửa ngẫu nhiên,
+    để khi Graph API sập, các bài lỗi cùng lúc không retry dồn vào cùng một thời điểm.
+    """
+    ceiling = min(PUBLISH_RETRY_MAX_SECONDS, PUBLISH_RETRY_BASE_SECONDS * (2 ** max(attempt - 1, 0)))
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+def claim_post(db: Session, post_id: int, allow_failed: bool = False) -> bool:
+    """
+    Chuyển bài sang publishing một cách nguyên tử (UPDATE có điều kiện).
+    Chỉ một worker nhận được bài -> không bao giờ đăng trùng.
+    Bài publishing quá hạn lease (worker chết) cũng được nhận lại.
+    """
+    now = datetime.utcnow()
+    claimable = [PostStatus.PENDING, PostStatus.RETRY_WAIT]
+    if allow_failed:
+        claimable.append(PostStatus.FAILED)
+    claimed = (
+        db.query(Post)
+        .filter(
+            Post.id == post_id,
+            Post.posted.is_(False),
+            (Post.status.in_(claimable))
+            | ((Post.status == PostStatus.PUBLISHING) & (Post.next_attempt_at <= now)),
+        )
+        .update(
+            {
+                Post.status: PostStatus.PUBLISHING,
+                Post.next_attempt_at: now + timedelta(seconds=PUBLISH_LEASE_SECONDS),
+            },
+            synchronize_session=False,
+        )
+    )
+    db.commit()
+    return claimed == 1
+
+
+def get_page_token(db: Session, post: Post) -> Optional[FacebookToken]:
+    # Lấy token FB của user (demo: 1 token lấy đầu tiên)
+    return db.query(FacebookToken).filter(FacebookToken.user_id == post.user_id).first()
+
+
+def publish_post(db: Session, post: Post, token: FacebookToken) -> dict:
+    """
+    Đăng 1 bài đã được claim lên Facebook và cập nhật trạng thái posted.
+    Lỗi được raise ra ngoài để caller ghi nhận qua record_publish_failure.
+    """
+    # Lấy ảnh kèm post (kèm facebook_photo_id nếu đã pre-stage / lần trước upload được một phần)
+    image_data = load_post_images(db, post.id, page_id=token.page_id)
+    video_data = load_post_videos(db, post.id)
+
+    if video_data:
+        # Bài video: tiếp tục từ đoạn Facebook đã xác nhận ở lần trước (nếu có)
+        result = FacebookAPI.post_video_resumable(
+            token.access_token,
+            token.page_id,
+            post.content,
+            video_data[0],
+            on_progress=video_checkpoint(db, post.id)
+        )
+    else:
+        result = FacebookAPI.post_to_facebook_with_images(
+            token.access_token,
+            token.page_id,
+            post.content,
+            image_data,
+            on_photo_uploaded=photo_checkpoint(db, token.page_id)
+        )
+
+    # Cập nhật trạng thái sau khi đăng thành công
+    post.posted = True
+    post.status = PostStatus.POSTED
+    post.attempt_count = (post.attempt_count or 0) + 1
+    post.last_error = None
+    post.next_attempt_at = None
+    post.facebook_post_id = result.get("post_id")
+    post.posted_at = datetime.now(timezone.utc)
+    post.page_id = token.page_id
+    if post.scheduled_time:
+        post.publish_lag_seconds = (to_utc_naive(post.posted_at) - post.scheduled_time).total_seconds()
+    bump_publish_stats(db, token.page_id, post.posted_at, publishes=1, images=len(image_data))
+    if post.facebook_post_id:
+        # Đăng ký theo dõi tương tác (collect_post_insights lấy lần đầu sau vài phút)
+        db.add(PostMetric(
+            post_id=post.id,
+            facebook_post_id=post.facebook_post_id,
+            next_refresh_at=datetime.utcnow() + INSIGHTS_REFRESH_SCHEDULE[0][1],
+        ))
+    db.commit()
+    return result
+
+
+def record_publish_failure(db: Session, post_id: int, error) -> Optional[Post]:
+    """
+    Ghi nhận 1 lần đăng thất bại:
+    - tăng attempt_count, lưu last_error
+    - còn lượt -> retry_wait với next_attempt_at theo backoff; hết lượt -> failed (dead-letter)
+    """
+    db.rollback()
+    post = db.query(Post).filter(Post.id == post_id).first()
+    if not post:
+        return None
+
+    message = getattr(error, "detail", None) or str(error) or type(error).__name__
+    if not post.page_id:
+        token = get_page_token(db, post)
+        post.page_id = token.page_id if token else None
+    bump_publish_stats(db, post.page_id, datetime.utcnow(), failures=1)
+    post.attempt_count = (post.attempt_count or 0) + 1
+    post.last_error = str(message)[:2000]
+    if post.attempt_count >= PUBLISH_MAX_ATTEMPTS:
+        post.status = PostStatus.FAILED
+        post.next_attempt_at = None
+        print(f"Post {post_id} chuyển sang dead-letter sau {post.attempt_count} lần thử: {post.last_error}")
+    else:
+        delay = retry_delay_seconds(post.attempt_count)
+        post.status = PostStatus.RETRY_WAIT
+        post.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+        print(f"Post {post_id} lỗi lần {post.attempt_count}, thử lại sau {delay:.0f}s: {post.last_error}")
+    db.commit()
+    return post
+
+
+def post_scheduled_content(post_id: int):
+    """
+    Hàm worker do APScheduler / dispatcher gọi khi tới thời gian đăng (hoặc giờ retry).
     Nó:
-      - load post, images, token từ DB
-      - gọi FacebookAPI.post_to_facebook_with_images(...)
-      - cập nhật trạng thái post trong DB (posted, facebook_post_id, posted_at)
+      - claim post (pending / retry_wait -> publishing)
+      - load token, images; gọi FacebookAPI.post_to_facebook_with_images(...)
+      - thành công: posted; thất bại: retry_wait hoặc failed (record_publish_failure)
     """
     db = SessionLocal()  # khởi tạo session mới cho background job
     try:
-        post = db.query(Post).filter(Post.id == post_id).first()
-        if not post or post.posted:
-            # Nếu không tồn tại hoặc đã đăng rồi thì exit im lặng
+        if not claim_post(db, post_id):
+            # Không tồn tại, đã đăng, hoặc worker khác đang xử lý -> bỏ qua
             return
-        
-        # Lấy token FB của user (demo: 1 token lấy đầu tiên)
-        token = db.query(FacebookToken).filter(FacebookToken.user_id == post.user_id).first()
-        if not token:
-            # Không có token -> không thể đăng
+        post = db.query(Post).filter(Post.id == post_id).first()
+
+        try:
+            token = get_page_token(db, post)
+            if not token:
+                # Không có token -> tính là 1 lần thất bại (không còn im lặng bỏ qua)
+                raise PublishError("Facebook token not configured for this user.")
+
+            result = publish_post(db, post, token)
+            print(f"Successfully posted to Facebook: {result}")
+        except Exception as e:
+            # Log lỗi, job không crash scheduler; hẹn giờ retry hoặc chuyển dead-letter
+            print(f"Error posting to Facebook: {getattr(e, 'detail', None) or e}")
+            record_publish_failure(db, post_id, e)
             return
-        
-        # Lấy ảnh kèm post
-        images = db.query(PostImage).filter(PostImage.post_id == post_id).all()
-        image_data = []
-        for img in images:
-            image_data.append({
-                'image_url': img.image_url,
-                'image_path': img.image_path
-            })
-        
-        # Gọi FB API để đăng
+
+        # --- BƯỚC GỬI EMAIL THÔNG BÁO ---
         try:
-            result = FacebookAPI.post_to_facebook_with_images(
-                token.access_token,
-                token.page_id,
-                post.content,
-                image_data
+            send_email_notification(
+                post.id, 
+                post.content, 
+                post.facebook_post_id, 
+                post.posted_at
             )
-            
-            # Cập nhật trạng thái sau khi đăng thành công
-            post.posted = True
-            post.facebook_post_id = result.get("post_id")
-            post.posted_at = datetime.now(timezone.utc)
-            db.commit()
-            
-            print(f"Successfully posted to Facebook: {result}")
+            print("STATUS: Đã cố gắng gửi email thông báo.") # <-- Thêm log này
+        except Exception as email_e:
+            # Log riêng lỗi gửi email (RẤT QUAN TRỌNG)
+            print(f"LỖI GỬI EMAIL (Background Job): {email_e}")
+        # --------------------------------------
+
+    finally:
+        db.close()
+
+
+# ------------------------------
+# FAIR-SHARE DISPATCH (chia lượt đăng công bằng giữa các tenant)
+# ------------------------------
+# Tenant = user_id của bài. Mỗi lượt, dispatcher lấy hàng đợi bài tới hạn của từng tenant
+# rồi chia lượt bằng smooth weighted round-robin (như nginx upstream): tenant hẹn hàng nghìn
+# bài cùng một phút chỉ nhận phần lượt theo trọng số, bài của tenant khác không bị xếp sau.
+# - TENANT_WEIGHTS: trọng số riêng dạng "user_id:weight,..." (vd "7:3,12:2"), mặc định 1
+# - TENANT_MAX_CONCURRENCY: số bài tối đa của 1 tenant được đăng cùng lúc
+# - PUBLISH_WORKERS: số thread đăng song song
+PUBLISH_WORKERS = int(os.getenv("PUBLISH_WORKERS", 4))
+TENANT_MAX_CONCURRENCY = int(os.getenv("TENANT_MAX_CONCURRENCY", 2))
+TENANT_LAG_SAMPLES = 500  # số mẫu độ trễ gần nhất giữ lại cho mỗi tenant
+
+
+def _parse_tenant_weights(raw: str) -> dict:
+    weights = {}
+    for part in raw.split(","):
+        if not part.strip():
+            continue
+        try:
+            user_id, weight = part.split(":")
+            weights[int(user_id)] = max(1, int(weight))
+        except ValueError:
+            print(f"CẢNH BÁO: bỏ qua giá trị TENANT_WEIGHTS không hợp lệ: {part!r}")
+    return weights
+
+
+TENANT_WEIGHTS = _parse_tenant_weights(os.getenv("TENANT_WEIGHTS", ""))
+
+# Điểm round-robin của từng tenant, giữ qua các lượt quét
+# (lượt sau tiếp tục vòng quay, không ưu tiên lại tenant đứng đầu)
+_tenant_rr_current = {}
+# Được set khi có yêu cầu đánh thức lúc dispatcher đang chạy -> chạy thêm 1 lượt sau lượt hiện tại
+_dispatch_wakeup = threading.Event()
+# Số liệu dispatch theo tenant: chỉ có ở process đang chạy scheduler
+_tenant_dispatch_stats = {}
+_tenant_stats_lock = threading.Lock()
+
+
+def tenant_weight(user_id) -> int:
+    return TENANT_WEIGHTS.get(user_id, 1)
+
+
+def _next_tenant(queues: dict, inflight: Counter):
+    """
+    Chọn tenant kế tiếp (smooth weighted round-robin) trong các tenant còn bài chờ
+    và chưa chạm trần TENANT_MAX_CONCURRENCY. Không còn ai hợp lệ -> None.
+    """
+    eligible = [t for t, queue in queues.items() if queue and inflight[t] < TENANT_MAX_CONCURRENCY]
+    if not eligible:
+        return None
+    total = 0
+    for tenant in eligible:
+        _tenant_rr_current[tenant] = _tenant_rr_current.get(tenant, 0) + tenant_weight(tenant)
+        total += tenant_weight(tenant)
+    chosen = max(eligible, key=lambda t: _tenant_rr_current[t])
+    _tenant_rr_current[chosen] -= total
+    return chosen
+
+
+def _tenant_stats(user_id) -> dict:
+    stats = _tenant_dispatch_stats.get(user_id)
+    if stats is None:
+        stats = _tenant_dispatch_stats[user_id] = {
+            "dispatched": 0,
+            "inflight": 0,
+            "max_lag": 0.0,
+            "lags": deque(maxlen=TENANT_LAG_SAMPLES),
+        }
+    return stats
+
+
+def _record_dispatch_start(user_id, lag_seconds: float):
+    with _tenant_stats_lock:
+        stats = _tenant_stats(user_id)
+        stats["dispatched"] += 1
+        stats["inflight"] += 1
+        stats["lags"].append(lag_seconds)
+        stats["max_lag"] = max(stats["max_lag"], lag_seconds)
+
+
+def _record_dispatch_end(user_id):
+    with _tenant_stats_lock:
+        _tenant_stats(user_id)["inflight"] -= 1
 
-            # --- BƯỚC GỬI EMAIL THÔNG BÁO ---
+
+def _due_post_filter(now: datetime):
+    """Bài tới hạn: pending / retry_wait có next_attempt_at <= now, hoặc publishing quá hạn lease."""
+    return (
+        Post.status.in_([PostStatus.PENDING, PostStatus.RETRY_WAIT, PostStatus.PUBLISHING]),
+        Post.next_attempt_at <= now,
+    )
+
+
+def _dispatch_batch() -> int:
+    """
+    1 lượt: tối đa PUBLISH_BATCH_SIZE bài, chia lượt giữa các tenant, chạy song song
+    PUBLISH_WORKERS thread. Trả về số bài đã đưa vào xử lý.
+    """
+    now = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        due = _due_post_filter(now)
+        tenants = [row.user_id for row in db.query(Post.user_id).filter(*due).distinct()]
+        # Mỗi tenant chỉ lấy phần đầu hàng đợi (index user_id, status, next_attempt_at)
+        queues = {
+            user_id: deque(
+                db.query(Post.id, Post.next_attempt_at)
+                .filter(*due, Post.user_id == user_id)
+                .order_by(Post.next_attempt_at)
+                .limit(PUBLISH_BATCH_SIZE)
+                .all()
+            )
+            for user_id in sorted(tenants, key=lambda t: (t is None, t))
+        }
+    finally:
+        db.close()
+
+    # Tenant không còn bài chờ thì bỏ điểm round-robin cũ (tránh dồn điểm khi quay lại)
+    for tenant in list(_tenant_rr_current):
+        if tenant not in queues:
+            del _tenant_rr_current[tenant]
+
+    inflight = Counter()
+    futures = {}
+    submitted = 0
+    with ThreadPoolExecutor(max_workers=PUBLISH_WORKERS, thread_name_prefix="publish") as pool:
+        while True:
+            tenant = None
+            if submitted < PUBLISH_BATCH_SIZE and len(futures) < PUBLISH_WORKERS:
+                tenant = _next_tenant(queues, inflight)
+            if tenant is not None:
+                post_id, due_at = queues[tenant].popleft()
+                _record_dispatch_start(tenant, max(0.0, (datetime.utcnow() - due_at).total_seconds()))
+                inflight[tenant] += 1
+                futures[pool.submit(post_scheduled_content, post_id)] = tenant
+                submitted += 1
+                continue
+            if not futures:
+                break
+            # Hết worker rảnh hoặc các tenant còn bài đều chạm trần -> chờ 1 bài xong
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                tenant = futures.pop(future)
+                inflight[tenant] -= 1
+                _record_dispatch_end(tenant)
+                if future.exception():
+                    print(f"LỖI DISPATCH (tenant {tenant}): {future.exception()}")
+    return submitted
+
+
+def dispatch_due_posts():
+    """
+    Job định kỳ: đăng các bài tới hạn, chia lượt công bằng giữa các tenant (xem _dispatch_batch).
+    Lượt đầy (hoặc có wake_dispatcher trong lúc chạy) thì quét tiếp ngay, mỗi lượt xếp lại
+    theo tenant, cho tới khi hết backlog. Bù cho job bị mất khi restart và xử lý các lần retry.
+    """
+    while True:
+        _dispatch_wakeup.clear()
+        if _dispatch_batch() < PUBLISH_BATCH_SIZE and not _dispatch_wakeup.is_set():
+            break
+
+
+def wake_dispatcher():
+    """
+    Cho dispatch_due_posts chạy ngay thay vì chờ chu kỳ quét. Job DateTrigger của từng bài
+    chỉ gọi hàm này, để bài tới giờ vẫn đi qua hàng đợi công bằng thay vì đăng thẳng.
+    Nếu dispatcher đang chạy, cờ _dispatch_wakeup khiến nó quét thêm 1 lượt ngay sau lượt hiện tại.
+    """
+    if not scheduler.running:
+        return
+    _dispatch_wakeup.set()
+    try:
+        scheduler.modify_job("dispatch_due_posts", next_run_time=datetime.now(timezone.utc))
+    except JobLookupError:
+        pass
+
+
+scheduler.add_job(
+    dispatch_due_posts,
+    "interval",
+    seconds=PUBLISH_POLL_INTERVAL_SECONDS,
+    id="dispatch_due_posts",
+    replace_existing=True,
+    max_instances=1,
+    coalesce=True,
+)
+
+# ------------------------------
+# PRE-STAGING (upload ảnh trước giờ đăng)
+# ------------------------------
+def prestage_upcoming_media(batch_size: int = None) -> int:
+    """
+    Job định kỳ: với các bài pending sẽ tới hạn trong PRESTAGE_MINUTES phút, upload sẵn ảnh
+    (unpublished) và lưu facebook_photo_id; tới giờ publish_post chỉ còn gọi /feed.
+    - ảnh đã stage nhưng cũ / khác page: xóa ảnh cũ trên Facebook (best-effort) rồi stage lại
+    - ghi id theo kiểu compare-and-set: nếu publish đã tự upload ảnh đó trong lúc này thì
+      giữ id của publish và xóa bản vừa stage
+    Lỗi của 1 bài được log + ghi vào prestage_error; bài đó chỉ được thử lại sau
+    PRESTAGE_RETRY_SECONDS và xếp sau các bài chưa lỗi (lúc đăng thật ảnh vẫn được upload
+    như bình thường).
+    """
+    if PRESTAGE_MINUTES <= 0:
+        return 0
+    batch_size = batch_size or PRESTAGE_BATCH_SIZE
+    now = datetime.utcnow()
+    stale_before = now - timedelta(hours=PRESTAGE_MAX_AGE_HOURS)
+    needs_staging = exists().where(
+        PostImage.post_id == Post.id,
+        (PostImage.facebook_photo_id.is_(None)) | (PostImage.facebook_photo_uploaded_at < stale_before),
+    )
+    retry_before = now - timedelta(seconds=PRESTAGE_RETRY_SECONDS)
+    staged = 0
+    db = SessionLocal()
+    try:
+        posts = (
+            db.query(Post)
+            .filter(
+                Post.status == PostStatus.PENDING,
+                Post.next_attempt_at > now,
+                Post.next_attempt_at <= now + timedelta(minutes=PRESTAGE_MINUTES),
+                (Post.prestage_error.is_(None)) | (Post.prestage_attempted_at < retry_before),
+                needs_staging,
+            )
+            .order_by(Post.prestage_error.isnot(None), Post.next_attempt_at)
+            .limit(batch_size)
+            .all()
+        )
+        for post in posts:
+            post.prestage_attempted_at = now
+        db.commit()
+
+        for post in posts:
+            post_id = post.id
+            error = None
+            token = get_page_token(db, post)
+            if not token:
+                error = "No Facebook page token"
             try:
-                send_email_notification(
-                    post.id, 
-                    post.content, 
-                    post.facebook_post_id, 
-                    post.posted_at
+                for image in load_post_images(db, post_id) if token else []:
+                    old_photo_id = image['facebook_photo_id']
+                    if old_photo_id and not staged_photo_is_stale(image, token.page_id, now):
+                        continue
+                    photo_id = FacebookAPI.upload_unpublished_photo(token.access_token, token.page_id, image)
+                    if not photo_id:
+                        error = f"Image {image['id']} has no uploaded file or URL"
+                        continue
+                    updated = (
+                        db.query(PostImage)
+                        .filter(
+                            PostImage.id == image['id'],
+                            PostImage.facebook_photo_id.is_(None) if old_photo_id is None
+                            else PostImage.facebook_photo_id == old_photo_id,
+                        )
+                        .update(
+                            {
+                                PostImage.facebook_photo_id: photo_id,
+                                PostImage.facebook_photo_uploaded_at: datetime.utcnow(),
+                                PostImage.facebook_page_id: token.page_id,
+                            },
+                            synchronize_session=False,
+                        )
+                    )
+                    db.commit()
+                    if not updated:
+                        FacebookAPI.delete_object(token.access_token, photo_id)
+                        continue
+                    if old_photo_id:
+                        FacebookAPI.delete_object(token.access_token, old_photo_id)
+                    staged += 1
+            except Exception as e:
+                db.rollback()
+                error = str(getattr(e, 'detail', None) or e)
+            if error:
+                print(f"LỖI PRE-STAGE post {post_id}: {error}")
+            db.query(Post).filter(Post.id == post_id).update(
+                {Post.prestage_error: error}, synchronize_session=False
+            )
+            db.commit()
+    finally:
+        db.close()
+
+    if staged:
+        print(f"Pre-stage: đã upload sẵn {staged} ảnh.")
+    return staged
+
+
+def discard_staged_photos(access_token: str, photo_ids: List[str]):
+    """Xóa các ảnh unpublished đã stage của bài bị xóa trước khi đăng (chạy nền, best-effort)."""
+    for photo_id in photo_ids:
+        FacebookAPI.delete_object(access_token, photo_id)
+
+
+if PRESTAGE_MINUTES > 0:
+    scheduler.add_job(
+        prestage_upcoming_media,
+        "interval",
+        seconds=PRESTAGE_INTERVAL_SECONDS,
+        id="prestage_upcoming_media",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+    )
+
+# ------------------------------
+# PUBLISHING STATS (rollup theo giờ / ngày)
+# ------------------------------
+# Dashboard chỉ đọc publish_stats (vài dòng / page / ngày), không quét bảng posts.
+STATS_GRANULARITIES = ("hour", "day")
+UNKNOWN_PAGE_ID = ""
+
+
+def stats_bucket_start(at: datetime, granularity: str) -> datetime:
+    at = to_utc_naive(at)
+    if granularity == "hour":
+        return at.replace(minute=0, second=0, microsecond=0)
+    return at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def bump_publish_stats(db: Session, page_id: Optional[str], at: datetime,
+                       publishes: int = 0, failures: int = 0, images: int = 0):
+    """
+    Cộng dồn số liệu vào bucket giờ + ngày chứa thời điểm `at`.
+    Upsert nguyên tử (INSERT ... ON CONFLICT DO UPDATE) trên SQLite / PostgreSQL.
+    Không commit: chạy trong transaction của caller (cùng lúc đổi trạng thái bài).
+    """
+    page_id = page_id or UNKNOWN_PAGE_ID
+    dialect = db.get_bind().dialect.name
+    for granularity in STATS_GRANULARITIES:
+        values = {
+            "page_id": page_id,
+            "granularity": granularity,
+            "bucket_start": stats_bucket_start(at, granularity),
+            "publishes": publishes,
+            "failures": failures,
+            "images": images,
+        }
+        if dialect in ("sqlite", "postgresql"):
+            insert = sqlite_insert if dialect == "sqlite" else postgresql_insert
+            stmt = insert(PublishStat).values(**values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["page_id", "granularity", "bucket_start"],
+                set_={
+                    "publishes": PublishStat.publishes + stmt.excluded.publishes,
+                    "failures": PublishStat.failures + stmt.excluded.failures,
+                    "images": PublishStat.images + stmt.excluded.images,
+                },
+            )
+            db.execute(stmt)
+        else:
+            row = (
+                db.query(PublishStat)
+                .filter_by(page_id=page_id, granularity=granularity, bucket_start=values["bucket_start"])
+                .with_for_update()
+                .first()
+            )
+            if row is None:
+                db.add(PublishStat(**values))
+            else:
+                row.publishes += publishes
+                row.failures += failures
+                row.images += images
+
+
+def _stats_history_rows(session: Session, posts_table, images_table):
+    """Dòng lịch sử cho rebuild_publish_stats (bảng hot hoặc archived_*), đọc theo lô."""
+    image_counts = (
+        session.query(images_table.c.post_id, func.count(images_table.c.id).label("images"))
+        .group_by(images_table.c.post_id)
+        .subquery()
+    )
+    return (
+        session.query(
+            posts_table.c.user_id, posts_table.c.page_id, posts_table.c.posted, posts_table.c.posted_at,
+            posts_table.c.scheduled_time, posts_table.c.attempt_count, image_counts.c.images,
+        )
+        .outerjoin(image_counts, image_counts.c.post_id == posts_table.c.id)
+        .yield_per(1000)
+    )
+
+
+def rebuild_publish_stats():
+    """
+    Job backfill: tính lại toàn bộ publish_stats từ lịch sử bảng posts + archive (đọc theo lô).
+    - publishes / images: theo posted_at của bài đã đăng
+    - failures: lịch sử không lưu thời điểm từng lần lỗi, nên ước lượng bằng attempt_count
+      (trừ lần thành công) và tính vào bucket của scheduled_time
+    - bài cũ chưa có page_id: dùng page của token đầu tiên của user
+    """
+    db = SessionLocal()
+    archive_db = get_archive_session()
+    try:
+        user_pages = {}
+        for token in db.query(FacebookToken.user_id, FacebookToken.page_id).order_by(FacebookToken.id):
+            user_pages.setdefault(token.user_id, token.page_id)
+
+        sources = [_stats_history_rows(db, Post.__table__, PostImage.__table__)]
+        if archive_db is not None:
+            sources.append(_stats_history_rows(
+                archive_db, ARCHIVED_TABLES["posts"], ARCHIVED_TABLES["post_images"]
+            ))
+
+        totals = {}
+        def add(page_id, at, publishes=0, failures=0, images=0):
+            for granularity in STATS_GRANULARITIES:
+                key = (page_id or UNKNOWN_PAGE_ID, granularity, stats_bucket_start(at, granularity))
+                bucket = totals.setdefault(key, [0, 0, 0])
+                bucket[0] += publishes
+                bucket[1] += failures
+                bucket[2] += images
+
+        for row in (row for rows in sources for row in rows):
+            page_id = row.page_id or user_pages.get(row.user_id)
+            failed_attempts = (row.attempt_count or 0) - (1 if row.posted else 0)
+            if row.posted and row.posted_at:
+                add(page_id, row.posted_at, publishes=1, images=row.images or 0)
+            if failed_attempts > 0 and row.scheduled_time:
+                add(page_id, row.scheduled_time, failures=failed_attempts)
+
+        db.query(PublishStat).delete(synchronize_session=False)
+        db.bulk_insert_mappings(PublishStat, [
+            {
+                "page_id": page_id, "granularity": granularity, "bucket_start": bucket_start,
+                "publishes": publishes, "failures": failures, "images": images,
+            }
+            for (page_id, granularity, bucket_start), (publishes, failures, images) in totals.items()
+        ])
+        db.commit()
+        print(f"STATS: đã tính lại {len(totals)} bucket thống kê.")
+        return len(totals)
+    finally:
+        if archive_db is not None:
+            archive_db.close()
+        db.close()
+
+# ------------------------------
+# ENGAGEMENT INSIGHTS (job nền, đọc theo lô)
+# ------------------------------
+# Lấy reactions / comments / shares / reach của bài đã đăng bằng 1 request Graph cho
+# tối đa INSIGHTS_BATCH_SIZE bài (?ids=a,b,c), lưu vào post_metrics. API chỉ đọc bảng này.
+INSIGHTS_INTERVAL_SECONDS = int(os.getenv("INSIGHTS_INTERVAL_SECONDS", 300))
+INSIGHTS_BATCH_SIZE = min(int(os.getenv("INSIGHTS_BATCH_SIZE", 50)), 50)  # Graph giới hạn 50 id / request
+INSIGHTS_MAX_POSTS_PER_RUN = int(os.getenv("INSIGHTS_MAX_POSTS_PER_RUN", 500))
+
+# Lịch làm mới giảm dần theo tuổi bài: (tuổi tối đa, khoảng cách giữa 2 lần lấy).
+# Bài cũ hơn mục cuối cùng thì ngừng theo dõi.
+INSIGHTS_REFRESH_SCHEDULE = [
+    (timedelta(hours=1), timedelta(minutes=10)),
+    (timedelta(hours=6), timedelta(minutes=30)),
+    (timedelta(days=1), timedelta(hours=1)),
+    (timedelta(days=3), timedelta(hours=6)),
+    (timedelta(days=7), timedelta(hours=12)),
+    (timedelta(days=30), timedelta(days=1)),
+]
+INSIGHTS_FIELDS = (
+    "reactions.summary(total_count).limit(0),comments.summary(total_count).limit(0),shares,"
+    "insights.metric(post_impressions_unique)"
+)
+# Một số object (vd. ảnh đơn) không có shares / insights -> thử lại với field tối thiểu
+INSIGHTS_MINIMAL_FIELDS = "reactions.summary(total_count).limit(0),comments.summary(total_count).limit(0)"
+_insights_seeded = False
+
+
+def next_insights_refresh(posted_at: Optional[datetime], now: datetime) -> Optional[datetime]:
+    if posted_at is None:
+        return None
+    age = now - to_utc_naive(posted_at)
+    for max_age, interval in INSIGHTS_REFRESH_SCHEDULE:
+        if age < max_age:
+            return now + interval
+    return None
+
+
+def _parse_insights(data: dict, full_fields: bool = True) -> dict:
+    """Đọc kết quả Graph; Graph bỏ hẳn field shares khi bài chưa có lượt chia sẻ nào."""
+    reach = None
+    for metric in (data.get("insights") or {}).get("data", []):
+        if metric.get("name") == "post_impressions_unique" and metric.get("values"):
+            reach = metric["values"][0].get("value")
+    return {
+        "reactions": ((data.get("reactions") or {}).get("summary") or {}).get("total_count"),
+        "comments": ((data.get("comments") or {}).get("summary") or {}).get("total_count"),
+        "shares": (data.get("shares") or {}).get("count", 0) if full_fields else None,
+        "reach": reach,
+    }
+
+
+def fetch_insights_batch(access_token: str, facebook_ids: List[str]) -> dict:
+    """
+    Lấy số liệu cho nhiều bài bằng 1 request multi-id.
+    Trả dict {facebook_id: metrics dict hoặc {"error": ...}}.
+    Nếu request cả lô lỗi (thường do 1 object không hỗ trợ field), tách ra lấy từng bài.
+    """
+    def request(ids, fields):
+        return requests.get(
+            "https://graph.facebook.com/v18.0/",
+            params={"ids": ",".join(ids), "fields": fields, "access_token": access_token},
+            timeout=30,
+        )
+
+    response = request(facebook_ids, INSIGHTS_FIELDS)
+    if response.status_code == 200:
+        payload = response.json()
+        return {fid: _parse_insights(payload[fid]) if fid in payload else {"error": "not returned"}
+                for fid in facebook_ids}
+
+    if len(facebook_ids) > 1:
+        results = {}
+        for fid in facebook_ids:
+            results.update(fetch_insights_batch(access_token, [fid]))
+        return results
+
+    response = request(facebook_ids, INSIGHTS_MINIMAL_FIELDS)
+    fid = facebook_ids[0]
+    if response.status_code == 200 and fid in response.json():
+        return {fid: _parse_insights(response.json()[fid], full_fields=False)}
+    return {fid: {"error": response.text[:500]}}
+
+
+def seed_post_metrics(db: Session):
+    """Tạo dòng post_metrics cho các bài đã đăng trước khi có tính năng này (chạy 1 lần)."""
+    since = datetime.utcnow() - INSIGHTS_REFRESH_SCHEDULE[-1][0]
+    rows = (
+        db.query(Post.id, Post.facebook_post_id)
+        .filter(
+            Post.posted.is_(True),
+            Post.facebook_post_id.isnot(None),
+            Post.posted_at >= since,
+            ~exists().where(PostMetric.post_id == Post.id),
+        )
+        .all()
+    )
+    now = datetime.utcnow()
+    db.bulk_insert_mappings(PostMetric, [
+        {"post_id": row.id, "facebook_post_id": row.facebook_post_id, "next_refresh_at": now}
+        for row in rows
+    ])
+    db.commit()
+
+
+def collect_post_insights():
+    """
+    Job định kỳ: lấy số liệu cho các bài tới hạn làm mới (post_metrics.next_refresh_at <= now),
+    gom theo page (mỗi page 1 token), mỗi request Graph tối đa INSIGHTS_BATCH_SIZE bài.
+    """
+    global _insights_seeded
+    db = SessionLocal()
+    try:
+        if not _insights_seeded:
+            seed_post_metrics(db)
+            _insights_seeded = True
+
+        now = datetime.utcnow()
+        due = (
+            db.query(PostMetric, Post.page_id, Post.user_id, Post.posted_at)
+            .join(Post, Post.id == PostMetric.post_id)
+            .filter(PostMetric.next_refresh_at <= now)
+            .order_by(PostMetric.next_refresh_at)
+            .limit(INSIGHTS_MAX_POSTS_PER_RUN)
+            .all()
+        )
+        if not due:
+            return 0
+
+        # Gom theo token: ưu tiên token của đúng page đã đăng, fallback token đầu tiên của user
+        tokens_by_page = {t.page_id: t.access_token for t in db.query(FacebookToken).order_by(FacebookToken.id.desc())}
+        tokens_by_user = {t.user_id: t.access_token for t in db.query(FacebookToken).order_by(FacebookToken.id.desc())}
+        groups = {}
+        for metric, page_id, user_id, posted_at in due:
+            access_token = tokens_by_page.get(page_id) or tokens_by_user.get(user_id)
+            if not access_token:
+                metric.last_error = "No Facebook token for page"
+                metric.next_refresh_at = next_insights_refresh(posted_at, now)
+                continue
+            groups.setdefault(access_token, []).append((metric, posted_at))
+
+        for access_token, items in groups.items():
+            for start in range(0, len(items), INSIGHTS_BATCH_SIZE):
+                chunk = items[start:start + INSIGHTS_BATCH_SIZE]
+                try:
+                    results = fetch_insights_batch(access_token, [m.facebook_post_id for m, _ in chunk])
+                except requests.RequestException as e:
+                    results = {m.facebook_post_id: {"error": str(e)} for m, _ in chunk}
+                for metric, posted_at in chunk:
+                    data = results.get(metric.facebook_post_id, {"error": "not returned"})
+                    if "error" in data:
+                        metric.last_error = str(data["error"])
+                    else:
+                        metric.reactions = data["reactions"]
+                        metric.comments = data["comments"]
+                        metric.shares = data["shares"]
+                        metric.reach = data["reach"]
+                        metric.fetched_at = now
+                        metric.last_error = None
+                    metric.next_refresh_at = next_insights_refresh(posted_at, now)
+                db.commit()
+
+        db.commit()
+        return len(due)
+    finally:
+        db.close()
+
+
+scheduler.add_job(
+    collect_post_insights,
+    "interval",
+    seconds=INSIGHTS_INTERVAL_SECONDS,
+    id="collect_post_insights",
+    replace_existing=True,
+    max_instances=1,
+    coalesce=True,
+)
+
+# ------------------------------
+# ARCHIVE (hot / cold)
+# ------------------------------
+# Bài đã đăng quá ARCHIVE_AFTER_DAYS ngày được chuyển (kèm ảnh, video, số liệu tương tác)
+# sang các bảng archived_* ở DB riêng ARCHIVE_DATABASE_URL, để bảng posts mà scheduler /
+# dashboard truy vấn chỉ còn dữ liệu "nóng". ARCHIVE_AFTER_DAYS = 0: tắt archive (và không
+# đọc DB archive). Có thể trỏ ARCHIVE_DATABASE_URL về chính DATABASE_URL (bảng archived_* cùng DB).
+# - GET /posts/{id}, /posts/{id}/status, DELETE /posts/{id} tìm tiếp trong archive nếu không thấy
+# - export và tính lại thống kê đọc cả archive
+# - file ảnh / video của bài archive vẫn giữ ref_count (không bị GC)
+# - bài archive không còn trong index full-text của SQLite (trigger xóa khi rời bảng posts)
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", 0))
+ARCHIVE_DATABASE_URL = os.getenv("ARCHIVE_DATABASE_URL", "sqlite:///./autofb-archive.db")
+ARCHIVE_BATCH_SIZE = min(int(os.getenv("ARCHIVE_BATCH_SIZE", 500)), IN_CLAUSE_CHUNK)
+ARCHIVE_MAX_BATCHES_PER_RUN = int(os.getenv("ARCHIVE_MAX_BATCHES_PER_RUN", 20))
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", 3600))
+
+# (bảng, cột trỏ tới post id) được chuyển cùng nhau; posts đứng đầu
+ARCHIVE_MOVE_TABLES = (
+    ("posts", "id"),
+    ("post_images", "post_id"),
+    ("post_videos", "post_id"),
+    ("post_metrics", "post_id"),
+)
+
+
+def _build_archive_tables() -> dict:
+    """Bản sao cấu trúc các bảng hot với tên archived_*; chỉ giữ index tự sinh theo cột."""
+    archive_metadata = MetaData()
+    tables = {}
+    for name, _ in ARCHIVE_MOVE_TABLES:
+        table = Base.metadata.tables[name].to_metadata(archive_metadata, name=f"archived_{name}")
+        # Index đặt tên tay (vd. ix_posts_status_next_attempt_at) phục vụ hàng đợi, archive không cần
+        # và sẽ trùng tên nếu archive nằm cùng DB
+        for index in list(table.indexes):
+            if index.name and not index.name.startswith("ix_archived_"):
+                table.indexes.discard(index)
+        tables[name] = table
+    return tables
+
+
+ARCHIVED_TABLES = _build_archive_tables()
+
+
+def _archive_columns(columns):
+    return tuple(ARCHIVED_TABLES[column.class_.__tablename__].c[column.key] for column in columns)
+
+
+ARCHIVE_POST_COLUMNS = _archive_columns(POST_COLUMNS)
+ARCHIVE_IMAGE_COLUMNS = _archive_columns(POST_IMAGE_COLUMNS)
+ARCHIVE_VIDEO_COLUMNS = _archive_columns(POST_VIDEO_COLUMNS)
+
+_archive_session_factory = None
+_archive_lock = threading.Lock()
+
+
+def get_archive_session() -> Optional[Session]:
+    """Session tới DB archive (tạo engine + bảng ở lần gọi đầu); archive tắt -> None."""
+    global _archive_session_factory
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return None
+    with _archive_lock:
+        if _archive_session_factory is None:
+            if ARCHIVE_DATABASE_URL == SQLALCHEMY_DATABASE_URL:
+                archive_engine = engine
+            else:
+                archive_connect_args = (
+                    {"check_same_thread": False} if ARCHIVE_DATABASE_URL.startswith("sqlite") else {}
                 )
-                print("STATUS: Đã cố gắng gửi email thông báo.") # <-- Thêm log này
-            except Exception as email_e:
-                # Log riêng lỗi gửi email (RẤT QUAN TRỌNG)
-                print(f"LỖI GỬI EMAIL (Background Job): {email_e}")
-            # --------------------------------------
-            
-        except Exception as e:
-            # Log lỗi, job không crash scheduler
-            print(f"Error posting to Facebook: {e}")
-            db.rollback() # Nếu đăng FB thất bại, rollback DB
+                archive_engine = create_engine(ARCHIVE_DATABASE_URL, connect_args=archive_connect_args)
+            next(iter(ARCHIVED_TABLES.values())).metadata.create_all(bind=archive_engine)
+            # Cột mới của bảng hot cũng phải có ở archive (archive copy toàn bộ cột)
+            with archive_engine.begin() as conn:
+                add_missing_columns(conn, ARCHIVED_TABLES.values())
+            _archive_session_factory = sessionmaker(autocommit=False, autoflush=False, bind=archive_engine)
+    return _archive_session_factory()
+
+
+def archive_published_posts(batch_size: int = None, max_batches: int = None) -> int:
+    """
+    Job định kỳ: chuyển bài đã đăng trước (now - ARCHIVE_AFTER_DAYS) sang archive, từng lô:
+    1) copy lô sang archive (xóa trước bản ghi của chính bài đó do lần chạy dở trước) rồi commit
+    2) xóa lô khỏi các bảng hot rồi commit
+    Nếu dừng giữa 1) và 2), lần chạy sau copy lại đúng lô đó -> không mất / trùng dữ liệu.
+    Archive đã có bài khác cùng id (DB cũ trước khi posts có AUTOINCREMENT) -> bỏ qua bài đó,
+    không ghi đè.
+    """
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return 0
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    max_batches = max_batches or ARCHIVE_MAX_BATCHES_PER_RUN
+    cutoff = datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    moved = 0
+    last_id = 0
+    archived_posts = ARCHIVED_TABLES["posts"]
+    for _ in range(max_batches):
+        db = SessionLocal()
+        archive_db = get_archive_session()
+        try:
+            batch = {
+                row.id: (row.created_at, row.facebook_post_id)
+                for row in db.query(Post.id, Post.created_at, Post.facebook_post_id)
+                .filter(Post.status == PostStatus.POSTED, Post.posted_at < cutoff, Post.id > last_id)
+                .order_by(Post.id)
+                .limit(batch_size)
+            }
+            if not batch:
+                break
+            last_id = max(batch)
+
+            # Bản ghi archive cùng id chỉ được thay nếu là chính bài này (lần chạy trước dừng giữa chừng)
+            ids = list(batch)
+            for row in archive_db.execute(
+                select(archived_posts.c.id, archived_posts.c.created_at, archived_posts.c.facebook_post_id)
+                .where(archived_posts.c.id.in_(ids))
+            ):
+                if (row.created_at, row.facebook_post_id) != batch[row.id]:
+                    print(f"LỖI ARCHIVE: archive đã có bài khác với id {row.id}, giữ bài này trên DB hot.")
+                    ids.remove(row.id)
+            if not ids:
+                continue
+
+            for name, key in ARCHIVE_MOVE_TABLES:
+                hot_table, archive_table = Base.metadata.tables[name], ARCHIVED_TABLES[name]
+                rows = [dict(row._mapping) for row in db.execute(select(hot_table).where(hot_table.c[key].in_(ids)))]
+                archive_db.execute(archive_table.delete().where(archive_table.c[key].in_(ids)))
+                if rows:
+                    archive_db.execute(archive_table.insert(), rows)
+            archive_db.commit()
+
+            # Bảng con trước, posts sau cùng
+            for name, key in reversed(ARCHIVE_MOVE_TABLES):
+                hot_table = Base.metadata.tables[name]
+                db.execute(hot_table.delete().where(hot_table.c[key].in_(ids)))
+            db.commit()
+            moved += len(ids)
+        finally:
+            archive_db.close()
+            db.close()
+        if len(batch) < batch_size:
+            break
+
+    if moved:
+        print(f"ARCHIVE: đã chuyển {moved} bài sang archive.")
+    return moved
+
+
+def load_archived_post(post_id: int) -> Optional[dict]:
+    """Đọc 1 bài trong archive (cấu trúc như GET /posts/{id}); không có / archive tắt -> None."""
+    archive_db = get_archive_session()
+    if archive_db is None:
+        return None
+    try:
+        rows = archive_db.query(*ARCHIVE_POST_COLUMNS).filter(ARCHIVE_POST_COLUMNS[0] == post_id).all()
+        if not rows:
+            return None
+        return serialize_posts(archive_db, rows, archived=True)[0]
+    finally:
+        archive_db.close()
+
+
+def delete_archived_post(db: Session, post_id: int) -> bool:
+    """
+    Xóa 1 bài khỏi archive và giảm ref_count file ảnh / video của nó (trên DB hot).
+    Trả về False nếu bài không có trong archive.
+    """
+    archive_db = get_archive_session()
+    if archive_db is None:
+        return False
+    try:
+        posts_table = ARCHIVED_TABLES["posts"]
+        if not archive_db.execute(select(posts_table.c.id).where(posts_table.c.id == post_id)).first():
+            return False
+        images_table, videos_table = ARCHIVED_TABLES["post_images"], ARCHIVED_TABLES["post_videos"]
+        paths = [row.image_path for row in archive_db.execute(
+            select(images_table.c.image_path).where(images_table.c.post_id == post_id))]
+        paths += [row.video_path for row in archive_db.execute(
+            select(videos_table.c.video_path).where(videos_table.c.post_id == post_id))]
+        for name, key in reversed(ARCHIVE_MOVE_TABLES):
+            archive_table = ARCHIVED_TABLES[name]
+            archive_db.execute(archive_table.delete().where(archive_table.c[key] == post_id))
+        archive_db.commit()
+    finally:
+        archive_db.close()
+    adjust_media_refs(db, paths, -1)
+    db.commit()
+    return True
+
+
+if ARCHIVE_AFTER_DAYS > 0:
+    scheduler.add_job(
+        archive_published_posts,
+        "interval",
+        seconds=ARCHIVE_INTERVAL_SECONDS,
+        id="archive_published_posts",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+    )
+
+# ------------------------------
+# MEDIA STORE (sharded layout + reference counting + GC)
+# ------------------------------
+def _media_shard(filename: str) -> str:
+    """Thư mục con 2 cấp lấy từ sha1 của tên file, ví dụ "3f/a2"."""
+    digest = hashlib.sha1(filename.encode("utf-8")).hexdigest()
+    return os.path.join(digest[:2], digest[2:4])
+
+
+def media_file_path(filename: str) -> str:
+    """
+    Đường dẫn trên disk của file upload.
+    File cũ (trước khi chia thư mục) nằm thẳng trong UPLOAD_DIR vẫn được tìm thấy.
+    """
+    sharded = os.path.join(UPLOAD_DIR, _media_shard(filename), filename)
+    if not os.path.exists(sharded):
+        legacy = os.path.join(UPLOAD_DIR, filename)
+        if os.path.exists(legacy):
+            return legacy
+    return sharded
+
+
+def thumbnail_file_path(filename: str, size: int) -> str:
+    return os.path.join(THUMBNAIL_DIR, str(size), _media_shard(filename), filename)
 
+
+def media_cache_path(filename: str) -> str:
+    return os.path.join(MEDIA_CACHE_DIR, _media_shard(filename), filename)
+
+
+# Tổng dung lượng cache ước tính (None = chưa quét lần nào): chỉ quét thư mục khi vượt giới hạn
+_media_cache_bytes = None
+# Lần dọn trước không xuống dưới giới hạn (toàn file đang pin) -> chưa quét lại trước mốc này
+_media_cache_next_scan = 0.0
+_media_cache_lock = threading.Lock()
+_media_cache_prune_lock = threading.Lock()
+
+
+def _media_cache_account(delta: int):
+    global _media_cache_bytes
+    with _media_cache_lock:
+        if _media_cache_bytes is not None:
+            _media_cache_bytes += delta
+
+
+def prune_media_cache(keep: Optional[str] = None):
+    """
+    Giữ cache đọc-qua dưới MEDIA_CACHE_MAX_MB: xóa file có mtime cũ nhất (mtime được chạm khi dùng).
+    Không bao giờ xóa: file `keep` (vừa fetch, sắp được mở), file dùng trong MEDIA_CACHE_PIN_SECONDS
+    gần đây, file .tmp đang tải. 1 file lớn hơn cả giới hạn vẫn được giữ tới khi hết thời gian pin.
+    """
+    global _media_cache_bytes, _media_cache_next_scan
+    limit = MEDIA_CACHE_MAX_MB * 1024 * 1024
+    with _media_cache_lock:
+        if _media_cache_bytes is not None and (
+            _media_cache_bytes <= limit or time.time() < _media_cache_next_scan
+        ):
+            return
+    # Chỉ 1 thread quét / dọn mỗi lúc, các thread khác bỏ qua
+    if not _media_cache_prune_lock.acquire(blocking=False):
+        return
+    try:
+        entries = []
+        for root, _, files in os.walk(MEDIA_CACHE_DIR):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat_result = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat_result.st_mtime, stat_result.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        pin_cutoff = time.time() - MEDIA_CACHE_PIN_SECONDS
+        for mtime, size, path in sorted(entries):
+            if total <= limit:
+                break
+            if path == keep or mtime >= pin_cutoff:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with _media_cache_lock:
+            _media_cache_bytes = total
+            _media_cache_next_scan = time.time() + min(MEDIA_CACHE_PIN_SECONDS, 60) if total > limit else 0.0
+    finally:
+        _media_cache_prune_lock.release()
+
+
+class LocalStorage:
+    """
+    Lưu file trên disk của node này (UPLOAD_DIR, thư mục con theo hash).
+    location trả về là đường dẫn tương đối, vd uploads/3f/a2/<uuid>.jpg
+    """
+    is_local = True
+
+    def save(self, filename: str, fileobj) -> tuple:
+        """Ghi fileobj theo từng khối. Trả (location, size)."""
+        file_path = os.path.join(UPLOAD_DIR, _media_shard(filename), filename)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as buffer:
+            shutil.copyfileobj(fileobj, buffer, STORAGE_CHUNK_SIZE)
+        return file_path, os.path.getsize(file_path)
+
+    def size(self, filename: str) -> Optional[int]:
+        try:
+            return os.path.getsize(media_file_path(filename))
+        except OSError:
+            return None
+
+    def fetch(self, filename: str) -> Optional[str]:
+        """Đường dẫn local để đọc file (đã ở sẵn trên disk); None nếu không có."""
+        path = media_file_path(filename)
+        return path if os.path.exists(path) else None
+
+    def delete(self, filename: str):
+        try:
+            os.remove(media_file_path(filename))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage:
+    """
+    Lưu file trên object storage tương thích S3 (AWS S3, MinIO...).
+    - key = S3_PREFIX + thư mục con theo hash + tên file (cùng bố cục với UPLOAD_DIR)
+    - ghi: upload_fileobj -> multipart theo khối STORAGE_CHUNK_SIZE
+    - đọc: stream theo Range (phục vụ /uploads) hoặc tải về cache đọc-qua (fetch, dùng khi đăng bài)
+    """
+    is_local = False
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("MEDIA_STORAGE=s3 cần cài boto3 (pip install boto3)")
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client_error = ClientError
+        self._transfer_config = TransferConfig(
+            multipart_threshold=STORAGE_CHUNK_SIZE,
+            multipart_chunksize=STORAGE_CHUNK_SIZE,
+        )
+        # MinIO / endpoint tự host thường không có DNS theo bucket -> dùng path-style
+        config = Config(s3={"addressing_style": "path"}) if endpoint_url else None
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region, config=config)
+
+    def key(self, filename: str) -> str:
+        return f"{self.prefix}{_media_shard(filename).replace(os.sep, '/')}/{filename}"
+
+    def _is_not_found(self, error) -> bool:
+        # Thiếu quyền s3:ListBucket (policy tối thiểu) -> S3 trả 403 AccessDenied cho key không tồn tại
+        # thay vì 404: coi như không có file (HEAD / GET)
+        return error.response.get("Error", {}).get("Code") in (
+            "404", "NoSuchKey", "NotFound", "403", "AccessDenied",
+        )
+
+    def save(self, filename: str, fileobj) -> tuple:
+        key = self.key(filename)
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        self.client.upload_fileobj(
+            fileobj, self.bucket, key,
+            ExtraArgs={"ContentType": content_type},
+            Config=self._transfer_config,
+        )
+        return f"s3://{self.bucket}/{key}", self.size(filename)
+
+    def stat(self, filename: str) -> Optional[dict]:
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(filename))
+        except self._client_error as e:
+            if self._is_not_found(e):
+                return None
+            raise
+        return {"size": head["ContentLength"], "etag": head["ETag"]}
+
+    def size(self, filename: str) -> Optional[int]:
+        info = self.stat(filename)
+        return info["size"] if info else None
+
+    def iter_range(self, filename: str, start: int, end: int):
+        """Stream đoạn [start, end] (end inclusive) theo từng khối."""
+        obj = self.client.get_object(Bucket=self.bucket, Key=self.key(filename), Range=f"bytes={start}-{end}")
+        body = obj["Body"]
+        try:
+            for chunk in body.iter_chunks(RANGE_CHUNK_SIZE):
+                yield chunk
+        finally:
+            body.close()
+
+    def fetch(self, filename: str) -> Optional[str]:
+        """
+        Đường dẫn local của file qua cache đọc-qua: có trong cache -> chạm mtime (LRU) và dùng luôn;
+        chưa có -> stream về file tạm rồi os.replace (không bao giờ đọc file tải dở).
+        """
+        path = media_cache_path(filename)
+        if os.path.exists(path):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                self.client.download_fileobj(self.bucket, self.key(filename), f, Config=self._transfer_config)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+            _media_cache_account(size)
+        except self._client_error as e:
+            if self._is_not_found(e):
+                return None
+            raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        prune_media_cache(keep=path)
+        return path
+
+    def delete(self, filename: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(filename))
+        path = media_cache_path(filename)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            _media_cache_account(-size)
+        except FileNotFoundError:
+            pass
+
+
+# Tạo ở lần dùng đầu (không import boto3 lúc import main.py)
+_media_storage = None
+_media_storage_lock = threading.Lock()
+
+
+def get_media_storage():
+    """Trả storage backend theo MEDIA_STORAGE ("local" | "s3")."""
+    global _media_storage
+    if _media_storage is None:
+        with _media_storage_lock:
+            if _media_storage is None:
+                if MEDIA_STORAGE == "s3":
+                    _media_storage = S3Storage(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, S3_REGION)
+                else:
+                    _media_storage = LocalStorage()
+    return _media_storage
+
+
+def media_local_path(path: Optional[str]) -> Optional[str]:
+    """
+    Đường dẫn local để đọc 1 file media đã upload (image_path / video_path lưu trong DB),
+    qua storage backend (S3 -> cache đọc-qua). Đường dẫn local cũ ngoài store vẫn dùng được.
+    """
+    if not path:
+        return None
+    local_path = get_media_storage().fetch(os.path.basename(path))
+    if local_path is None and os.path.exists(path):
+        return path
+    return local_path
+
+
+def media_size(path: Optional[str]) -> Optional[int]:
+    """Kích thước file media đã upload (theo storage backend); None nếu không có."""
+    if not path:
+        return None
+    size = get_media_storage().size(os.path.basename(path))
+    if size is None and os.path.exists(path):
+        return os.path.getsize(path)
+    return size
+
+
+def save_upload(file: UploadFile, db: Session, default_extension: str = 'jpg') -> dict:
+    """
+    Lưu 1 file upload vào storage (stream theo khối) và ghi bản ghi MediaFile (ref_count = 0).
+    Upload chưa được gắn vào post nào sẽ bị GC dọn sau MEDIA_GC_GRACE_HOURS.
+    """
+    file_extension = file.filename.split('.')[-1] if '.' in file.filename else default_extension
+    unique_filename = f"{uuid.uuid4()}.{file_extension}"
+    file_path, size = get_media_storage().save(unique_filename, file.file)
+
+    db.add(MediaFile(
+        filename=unique_filename,
+        file_path=file_path,
+        size=size,
+        ref_count=0,
+        orphaned_since=datetime.utcnow(),
+    ))
+    db.commit()
+
+    return {
+        "filename": unique_filename,
+        "file_path": file_path,
+        "url": f"/uploads/{unique_filename}",
+        "thumbnail_url": f"/uploads/thumbs/{THUMBNAIL_SIZES[1]}/{unique_filename}",
+        "size": size
+    }
+
+
+def adjust_media_refs(db: Session, image_paths: List[str], delta: int):
+    """
+    Tăng / giảm ref_count của các MediaFile tương ứng với image_paths (+1 khi gắn vào post,
+    -1 khi PostImage / PostVideo bị xóa). Không commit: chạy chung transaction với thay đổi đó.
+    """
+    counts = Counter(os.path.basename(p) for p in image_paths if p)
+    for filename, count in counts.items():
+        db.query(MediaFile).filter(MediaFile.filename == filename).update(
+            {MediaFile.ref_count: MediaFile.ref_count + delta * count},
+            synchronize_session=False,
+        )
+    if counts:
+        # ref_count > 0 -> không còn mồ côi; về 0 -> bắt đầu tính thời gian chờ GC
+        db.query(MediaFile).filter(MediaFile.filename.in_(list(counts))).update(
+            {MediaFile.orphaned_since: case(
+                (MediaFile.ref_count > 0, None),
+                else_=func.coalesce(MediaFile.orphaned_since, datetime.utcnow()),
+            )},
+            synchronize_session=False,
+        )
+
+
+def sweep_orphan_media(batch_size: int = None):
+    """
+    Job GC: xóa tối đa batch_size file mồ côi quá MEDIA_GC_GRACE_HOURS.
+    - Chỉ đọc theo index (ref_count = 0, orphaned_since cũ), không quét thư mục
+    - Xóa bản ghi trước (điều kiện ref_count = 0 để không đụng file vừa được gắn vào post),
+      sau đó mới xóa file gốc (trên storage) + thumbnail trên disk
+    - Xóa file lỗi (S3 / disk) -> khôi phục bản ghi với orphaned_since cũ để lượt sau thử lại,
+      không tính vào số file đã xóa
+    """
+    batch_size = batch_size or MEDIA_GC_BATCH_SIZE
+    cutoff = datetime.utcnow() - timedelta(hours=MEDIA_GC_GRACE_HOURS)
+    db = SessionLocal()
+    removed = 0
+    try:
+        candidates = (
+            db.query(MediaFile.id, MediaFile.filename, MediaFile.file_path, MediaFile.size,
+                     MediaFile.orphaned_since, MediaFile.created_at)
+            .filter(MediaFile.ref_count <= 0, MediaFile.orphaned_since < cutoff)
+            .order_by(MediaFile.orphaned_since)
+            .limit(batch_size)
+            .all()
+        )
+        for media in candidates:
+            filename = media.filename
+            deleted = (
+                db.query(MediaFile)
+                .filter(MediaFile.id == media.id, MediaFile.ref_count <= 0)
+                .delete(synchronize_session=False)
+            )
+            db.commit()
+            if not deleted:
+                continue
+
+            try:
+                get_media_storage().delete(filename)
+            except Exception as e:
+                print(f"LỖI GC: không xóa được {media.file_path}, thử lại ở lượt sau: {e}")
+                db.add(MediaFile(
+                    id=media.id,
+                    filename=filename,
+                    file_path=media.file_path,
+                    size=media.size,
+                    ref_count=0,
+                    orphaned_since=media.orphaned_since,
+                    created_at=media.created_at,
+                ))
+                db.commit()
+                continue
+            for path in [thumbnail_file_path(filename, size) for size in THUMBNAIL_SIZES]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"LỖI GC: không xóa được {path}: {e}")
+            removed += 1
     finally:
         db.close()
 
+    if removed:
+        print(f"GC media: đã xóa {removed} file mồ côi.")
+    return removed
+
+
+scheduler.add_job(
+    sweep_orphan_media,
+    "interval",
+    seconds=MEDIA_GC_INTERVAL_SECONDS,
+    id="media_gc",
+    replace_existing=True,
+    max_instances=1,
+    coalesce=True,
+)
+
 # ------------------------------
 # API ROUTES
 # ------------------------------
@@ -640,34 +3079,20 @@ async def root():
 # Upload single image
 # ------------------------------
 @app.post("/upload-image/")
-async def upload_image(file: UploadFile = File(...)):
+def upload_image(file: UploadFile = File(...), db: Session = Depends(get_db)):
     """
     Endpoint upload 1 ảnh:
     - validate content_type (phải là image/)
-    - lưu file vào UPLOAD_DIR với tên unique
+    - lưu file vào storage (UPLOAD_DIR hoặc S3, thư mục con theo hash) với tên unique
     - trả về filename, file_path, url relative (/uploads/...), size
     """
     # Validate file type
     if not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
     
-    # Tạo tên file duy nhất tránh trùng
-    file_extension = file.filename.split('.')[-1] if '.' in file.filename else 'jpg'
-    unique_filename = f"{uuid.uuid4()}.{file_extension}"
-    file_path = os.path.join(UPLOAD_DIR, unique_filename)
-    
     try:
-        # Lưu file
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # Trả thông tin file cho frontend
-        return {
-            "filename": unique_filename,
-            "file_path": file_path,
-            "url": f"/uploads/{unique_filename}",
-            "size": os.path.getsize(file_path)
-        }
+        # Lưu file + trả thông tin file cho frontend
+        return save_upload(file, db)
     except Exception as e:
         # Bắt lỗi lưu file
         raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
@@ -675,13 +3100,15 @@ async def upload_image(file: UploadFile = File(...)):
 # AI Content Generation
 # ------------------------------
 @app.post("/generate-content/")
-async def generate_content(request: GenerateContentRequest):
-    # 1. Kiểm tra client đã được khởi tạo thành công chưa
+def generate_content(request: GenerateContentRequest):
+    # 1. Lấy client (tạo ở lần gọi đầu) + kiểm tra đã khởi tạo thành công chưa
+    client = get_gemini_client()
     if client is None:
         raise HTTPException(
             status_code=500,
             detail={"error": "Dịch vụ AI (Gemini) chưa được khởi tạo. Vui lòng kiểm tra GEMINI_API_KEY."}
         )
+    from google.genai.errors import APIError
         
     try:
         prompt = request.prompt
@@ -734,77 +3161,351 @@ async def generate_content(request: GenerateContentRequest):
             # Lỗi API 500 hoặc các lỗi khác không thuộc 401/429
             detail = f"Lỗi API Gemini không xác định (Có thể là lỗi máy chủ Gemini): {error_message}"
 
-        print(f"LỖI XỬ LÝ API GEMINI: {error_message}") 
-        raise HTTPException(
-            status_code=status_code, 
-            detail={"error": detail}
-        )
+        print(f"LỖI XỬ LÝ API GEMINI: {error_message}") 
+        raise HTTPException(
+            status_code=status_code, 
+            detail={"error": detail}
+        )
+    except Exception as e:
+        # 5. XỬ LÝ LỖI CHUNG (Internal Server Error)
+        error_type = type(e).__name__
+        error_detail = str(e)
+        
+        # IN LOG CHỦ YẾU Ở ĐÂY ĐỂ CHẨN ĐOÁN
+        print("="*50)
+        print(f"LỖI PYTHON NGHIÊM TRỌNG TRONG ENDPOINT AI (500 Internal):")
+        # In traceback đầy đủ để chẩn đoán nguyên nhân
+        traceback.print_exc()
+        print(f"Loại lỗi: {error_type}")
+        print(f"Chi tiết lỗi: {error_detail}")
+        print("="*50)
+
+        # Trả về loại lỗi cụ thể cho frontend
+        raise HTTPException(
+            status_code=500, 
+            detail={"error": f"Lỗi máy chủ nội bộ: {error_type}. Vui lòng kiểm tra logs server để xem chi tiết."}
+        )
+# ------------------------------
+
+
+# ------------------------------
+# Upload multiple images
+# ------------------------------
+@app.post("/upload-multiple-images/")
+def upload_multiple_images(files: List[UploadFile] = File(...), db: Session = Depends(get_db)):
+    """
+    Upload nhiều file:
+    - lặp qua files, validate và lưu
+    - trả danh sách file đã upload
+    """
+    uploaded_files = []
+    
+    for file in files:
+        # Validate file type
+        if not file.content_type.startswith('image/'):
+            raise HTTPException(status_code=400, detail=f"File {file.filename} must be an image")
+        
+        try:
+            # Save file (tên unique, thư mục con theo hash)
+            uploaded_files.append(save_upload(file, db))
+        except Exception as e:
+            # Nếu 1 file lỗi, trả lỗi kèm tên file để debug
+            raise HTTPException(status_code=500, detail=f"Error uploading file {file.filename}: {str(e)}")
+    
+    return {"uploaded_files": uploaded_files}
+
+# ------------------------------
+# Upload video
+# ------------------------------
+@app.post("/upload-video/")
+def upload_video(file: UploadFile = File(...), db: Session = Depends(get_db)):
+    """
+    Upload 1 video (có thể vài trăm MB):
+    - validate content_type (phải là video/)
+    - file được copy từng khối vào storage (disk / S3 multipart); endpoint là def thường nên
+      việc ghi chạy trong threadpool, không chặn event loop
+    - trả về filename, file_path (dùng làm video_path khi tạo post), url, size
+    """
+    if not file.content_type.startswith('video/'):
+        raise HTTPException(status_code=400, detail="File must be a video")
+
+    try:
+        uploaded = save_upload(file, db, default_extension='mp4')
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
+    uploaded.pop("thumbnail_url", None)  # chưa sinh thumbnail cho video
+    return uploaded
+
+# ------------------------------
+# SERVE UPLOADS + THUMBNAILS
+# ------------------------------
+# Thay cho StaticFiles: thêm Cache-Control immutable, ETag / 304, Range (206)
+# và tùy chọn giao file cho Nginx (X-Accel-Redirect).
+# MEDIA_STORAGE=s3: file gốc được stream từ object storage qua backend (cùng header, Range),
+# thumbnail vẫn sinh và cache trên disk của từng node (dữ liệu phái sinh, tạo lại được).
+RANGE_CHUNK_SIZE = 64 * 1024
+
+
+def _check_upload_filename(filename: str):
+    """Chặn path traversal (chỉ nhận tên file trần)."""
+    if not filename or filename != os.path.basename(filename) or filename.startswith("."):
+        raise HTTPException(status_code=404, detail="File not found")
+
+
+def _make_etag(stat_result: os.stat_result) -> str:
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def _parse_range(range_header: str, file_size: int):
+    """
+    Parse header Range dạng "bytes=start-end" / "bytes=start-" / "bytes=-suffix".
+    Chỉ hỗ trợ 1 đoạn. Trả (start, end) (end inclusive) hoặc None nếu header không hợp lệ.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_str, _, end_str = spec.strip().partition("-")
+    try:
+        if start_str == "":
+            suffix = int(end_str)
+            if suffix <= 0:
+                return None
+            return max(file_size - suffix, 0), file_size - 1
+        start = int(start_str)
+        end = int(end_str) if end_str else file_size - 1
+    except ValueError:
+        return None
+    if start > end or start >= file_size:
+        return None
+    return start, min(end, file_size - 1)
+
+
+def _iter_file_range(path: str, start: int, end: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _media_headers(etag: str) -> dict:
+    return {
+        "Cache-Control": UPLOADS_CACHE_CONTROL,
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+    }
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    return bool(if_none_match) and (
+        if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]
+    )
+
+
+def _range_response(request: Request, headers: dict, etag: str, file_size: int, media_type: str, iter_range):
+    """Trả 206 / 416 nếu request có Range hợp lệ với If-Range; None -> trả cả file."""
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if not range_header or (if_range and if_range.strip() != etag):
+        return None
+    byte_range = _parse_range(range_header, file_size)
+    if byte_range is None:
+        headers["Content-Range"] = f"bytes */{file_size}"
+        return Response(status_code=416, headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    body = iter(()) if request.method == "HEAD" else iter_range(start, end)
+    return StreamingResponse(body, status_code=206, headers=headers, media_type=media_type)
+
+
+def serve_media_file(request: Request, path: str) -> Response:
+    """
+    Trả file media với header cache-friendly:
+    - ETag + If-None-Match -> 304
+    - Range / If-Range -> 206 (hoặc 416 nếu range sai)
+    - MEDIA_ACCEL_REDIRECT_PREFIX -> X-Accel-Redirect cho Nginx
+    """
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    etag = _make_etag(stat_result)
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = _media_headers(etag)
+
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    if MEDIA_ACCEL_REDIRECT_PREFIX:
+        # Nginx tự xử lý Range / sendfile; backend chỉ trả header
+        relative = os.path.relpath(path, UPLOAD_DIR).replace(os.sep, "/")
+        headers["X-Accel-Redirect"] = MEDIA_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + relative
+        return Response(headers=headers, media_type=media_type)
+
+    range_response = _range_response(
+        request, headers, etag, stat_result.st_size, media_type,
+        lambda start, end: _iter_file_range(path, start, end),
+    )
+    if range_response is not None:
+        return range_response
+
+    return FileResponse(
+        path,
+        headers=headers,
+        media_type=media_type,
+        stat_result=stat_result,
+        method=request.method,
+    )
+
+
+def serve_stored_media(request: Request, filename: str) -> Response:
+    """
+    Trả file gốc đã upload qua storage backend:
+    - local: serve_media_file (FileResponse / X-Accel-Redirect)
+    - S3: HEAD lấy size + ETag, body stream từ object storage theo từng khối (hỗ trợ Range)
+    """
+    storage = get_media_storage()
+    if storage.is_local:
+        return serve_media_file(request, media_file_path(filename))
+
+    info = storage.stat(filename)
+    if info is None:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    etag = info["etag"]
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    headers = _media_headers(etag)
+
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    def iter_range(start: int, end: int):
+        return storage.iter_range(filename, start, end)
+
+    range_response = _range_response(request, headers, etag, info["size"], media_type, iter_range)
+    if range_response is not None:
+        return range_response
+
+    headers["Content-Length"] = str(info["size"])
+    if request.method == "HEAD" or info["size"] == 0:
+        body = iter(())
+    else:
+        body = iter_range(0, info["size"] - 1)
+    return StreamingResponse(body, headers=headers, media_type=media_type)
+
+
+def get_or_create_thumbnail(source_path: str, size: int) -> Optional[str]:
+    """
+    Trả đường dẫn thumbnail (cạnh dài tối đa `size` px) của ảnh, tạo nếu chưa có.
+    - Ghi ra file tạm rồi os.replace -> không bao giờ phục vụ file thumbnail dở dang
+    - Nếu chưa cài Pillow hoặc ảnh không đọc được -> None (endpoint chuyển hướng sang ảnh gốc)
+    """
+    thumb_path = thumbnail_file_path(os.path.basename(source_path), size)
+    if os.path.exists(thumb_path):
+        return thumb_path
+
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        print("CẢNH BÁO: Chưa cài Pillow, trả ảnh gốc thay cho thumbnail.")
+        return None
+
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    tmp_path = f"{thumb_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with Image.open(source_path) as img:
+            image_format = img.format or "JPEG"
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((size, size))
+            if image_format == "JPEG" and img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.save(tmp_path, format=image_format, quality=82, optimize=True)
+        os.replace(tmp_path, thumb_path)
     except Exception as e:
-        # 5. XỬ LÝ LỖI CHUNG (Internal Server Error)
-        error_type = type(e).__name__
-        error_detail = str(e)
-        
-        # IN LOG CHỦ YẾU Ở ĐÂY ĐỂ CHẨN ĐOÁN
-        print("="*50)
-        print(f"LỖI PYTHON NGHIÊM TRỌNG TRONG ENDPOINT AI (500 Internal):")
-        # In traceback đầy đủ để chẩn đoán nguyên nhân
-        traceback.print_exc()
-        print(f"Loại lỗi: {error_type}")
-        print(f"Chi tiết lỗi: {error_detail}")
-        print("="*50)
+        print(f"LỖI TẠO THUMBNAIL {source_path} ({size}px): {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
 
-        # Trả về loại lỗi cụ thể cho frontend
-        raise HTTPException(
-            status_code=500, 
-            detail={"error": f"Lỗi máy chủ nội bộ: {error_type}. Vui lòng kiểm tra logs server để xem chi tiết."}
-        )
-# ------------------------------
+    return thumb_path
 
 
-# ------------------------------
-# Upload multiple images
-# ------------------------------
-@app.post("/upload-multiple-images/")
-async def upload_multiple_images(files: List[UploadFile] = File(...)):
+@app.api_route("/uploads/thumbs/{size}/{filename}", methods=["GET", "HEAD"])
+async def get_upload_thumbnail(size: int, filename: str, request: Request):
     """
-    Upload nhiều file:
-    - lặp qua files, validate và lưu
-    - trả danh sách file đã upload
+    Thumbnail của ảnh đã upload, ví dụ /uploads/thumbs/320/abcd.jpg
+    - size phải thuộc THUMBNAIL_SIZES
+    - lần đầu sinh thumbnail (trong threadpool), các lần sau đọc từ cache trên disk
+    - không tạo được thumbnail -> 302 sang ảnh gốc, không cache: URL thumbnail được cache
+      immutable 1 năm nên không bao giờ được trả nội dung ảnh gốc
     """
-    uploaded_files = []
-    
-    for file in files:
-        # Validate file type
-        if not file.content_type.startswith('image/'):
-            raise HTTPException(status_code=400, detail=f"File {file.filename} must be an image")
-        
-        # Tạo tên file unique
-        file_extension = file.filename.split('.')[-1] if '.' in file.filename else 'jpg'
-        unique_filename = f"{uuid.uuid4()}.{file_extension}"
-        file_path = os.path.join(UPLOAD_DIR, unique_filename)
-        
-        try:
-            # Save file
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            
-            uploaded_files.append({
-                "filename": unique_filename,
-                "file_path": file_path,
-                "url": f"/uploads/{unique_filename}",
-                "size": os.path.getsize(file_path)
-            })
-        except Exception as e:
-            # Nếu 1 file lỗi, trả lỗi kèm tên file để debug
-            raise HTTPException(status_code=500, detail=f"Error uploading file {file.filename}: {str(e)}")
-    
-    return {"uploaded_files": uploaded_files}
+    if size not in THUMBNAIL_SIZES:
+        raise HTTPException(status_code=404, detail=f"Thumbnail size must be one of {list(THUMBNAIL_SIZES)}")
+    _check_upload_filename(filename)
+    thumb_path = thumbnail_file_path(filename, size)
+    if not os.path.exists(thumb_path):
+        # Ảnh gốc lấy qua storage (S3 -> cache đọc-qua), chạy trong threadpool
+        source_path = await run_in_threadpool(get_media_storage().fetch, filename)
+        if source_path is None:
+            raise HTTPException(status_code=404, detail="File not found")
+        thumb_path = await run_in_threadpool(get_or_create_thumbnail, source_path, size)
+        if thumb_path is None:
+            return RedirectResponse(
+                f"/uploads/{filename}", status_code=302, headers={"Cache-Control": "no-cache"}
+            )
+    return serve_media_file(request, thumb_path)
+
+
+@app.api_route("/uploads/{filename}", methods=["GET", "HEAD"])
+async def get_upload(filename: str, request: Request):
+    """File gốc đã upload, ví dụ /uploads/abcd.jpg"""
+    _check_upload_filename(filename)
+    return await run_in_threadpool(serve_stored_media, request, filename)
+
+# ------------------------------
+# Helpers tạo bài (dùng chung cho /posts/ và /posts/create-and-publish)
+# ------------------------------
+def validate_post_media(images: List[PostImageCreate], videos: List[PostVideoCreate]):
+    # Facebook không cho đăng video kèm ảnh trong cùng 1 bài
+    if len(videos) > 1 or (videos and images):
+        raise HTTPException(status_code=400, detail="A post can have either images or a single video.")
+
+
+def add_post_media(db: Session, post_id: int, images: List[PostImageCreate], videos: List[PostVideoCreate]):
+    """Thêm PostImage / PostVideo cho bài và tăng ref_count file upload (không commit)."""
+    for image_data in images:
+        db.add(PostImage(
+            post_id=post_id,
+            image_url=image_data.image_url,
+            image_path=image_data.image_path
+        ))
+    for video_data in videos:
+        video_path = video_data.video_path
+        db.add(PostVideo(
+            post_id=post_id,
+            video_path=video_path,
+            file_size=media_size(video_path)
+        ))
+    # Đánh dấu các file upload đang được post này dùng (không bị GC)
+    adjust_media_refs(
+        db,
+        [image.image_path for image in images] + [video.video_path for video in videos],
+        +1
+    )
 
 # ------------------------------
 # Create a new post (and schedule if needed)
 # ------------------------------
 @app.post("/posts/", response_model=PostResponse)
-async def create_post(post: PostCreate, db: Session = Depends(get_db)):
+async def create_post(post: PostCreate, db: Session = Depends(get_db),
+                      user_id: int = Depends(get_current_user_id)):
     """
     Tạo 1 post mới:
     - Lưu Post vào DB
@@ -812,44 +3513,45 @@ async def create_post(post: PostCreate, db: Session = Depends(get_db)):
     - Nếu scheduled_time > now thì thêm job vào APScheduler
     - Trả về Post (kèm images)
     """
-    # Demo: dùng mặc định user_id = 1 (phải thay bằng auth sau này)
-    user_id = 1
+    validate_post_media(post.images, post.videos)
     
+    scheduled_time = to_utc_naive(post.scheduled_time)
     db_post = Post(
         user_id=user_id,
         content=post.content,
-        scheduled_time=post.scheduled_time
+        scheduled_time=scheduled_time,
+        status=PostStatus.PENDING,
+        attempt_count=0,
+        next_attempt_at=scheduled_time
     )
     
     db.add(db_post)
     db.commit()
     db.refresh(db_post)
     
-    # Lưu ảnh kèm bài
-    for image_data in post.images:
-        db_image = PostImage(
-            post_id=db_post.id,
-            image_url=image_data.image_url,
-            image_path=image_data.image_path
-        )
-        db.add(db_image)
+    # Lưu ảnh / video kèm bài
+    add_post_media(db, db_post.id, post.images, post.videos)
     
     db.commit()
     
-    # Schedule bài nếu scheduled_time trong tương lai
-    # CHÚ Ý: cần đảm bảo datetime được so sánh cùng timezone.
-    # File gốc coi scheduled_time như timezone-aware nếu client gửi kèm tz.
-    if post.scheduled_time > datetime.now(timezone.utc):
+    # Hẹn giờ: job DateTrigger chỉ đánh thức dispatcher đúng giờ đăng, việc đăng vẫn đi qua
+    # hàng đợi chia lượt theo tenant (dispatch_due_posts).
+    # scheduled_time đã được chuẩn hóa về UTC (naive) nên so sánh với utcnow.
+    # Job bị mất khi restart do chu kỳ quét của dispatch_due_posts bù lại.
+    # Chỉ thêm job khi scheduler chạy trong process này (worker web không chạy scheduler).
+    if scheduled_time > datetime.utcnow() and scheduler.running:
         scheduler.add_job(
-            post_scheduled_content,
-            DateTrigger(run_date=post.scheduled_time),
-            args=[db_post.id],
+            wake_dispatcher,
+            DateTrigger(run_date=scheduled_time.replace(tzinfo=timezone.utc)),
             id=f"post_{db_post.id}"
         )
+    else:
+        wake_dispatcher()
     
-    # Lấy lại images để attach vào response (PostResponse)
+    # Lấy lại images / videos để attach vào response (PostResponse)
     images = db.query(PostImage).filter(PostImage.post_id == db_post.id).all()
     db_post.images = images
+    db_post.videos = db.query(PostVideo).filter(PostVideo.post_id == db_post.id).all()
     
     return db_post
 
@@ -861,15 +3563,11 @@ async def get_posts(skip: int = 0, limit: int = 100, db: Session = Depends(get_d
     """
     Lấy danh sách posts (có hỗ trợ pagination bằng skip/limit)
     - đối với mỗi post attach list images để client dễ hiện thị
+    - dùng đường serialize nhanh (serialize_posts + FastJSONResponse);
+      response_model chỉ còn dùng cho tài liệu /docs
     """
-    posts = db.query(Post).offset(skip).limit(limit).all()
-    
-    # Attach images
-    for post in posts:
-        images = db.query(PostImage).filter(PostImage.post_id == post.id).all()
-        post.images = images
-    
-    return posts
+    rows = db.query(*POST_COLUMNS).offset(skip).limit(limit).all()
+    return FastJSONResponse(serialize_posts(db, rows))
 
 # ------------------------------
 # Get single post
@@ -877,14 +3575,18 @@ async def get_posts(skip: int = 0, limit: int = 100, db: Session = Depends(get_d
 @app.get("/posts/{post_id}", response_model=PostResponse)
 async def get_post(post_id: int, db: Session = Depends(get_db)):
     """
-    Lấy chi tiết 1 post theo id (kèm images)
+    Lấy chi tiết 1 post theo id (kèm images); bài đã archive được đọc từ DB archive
     """
     post = db.query(Post).filter(Post.id == post_id).first()
     if not post:
-        raise HTTPException(status_code=404, detail="Post not found")
+        archived = load_archived_post(post_id)
+        if archived is None:
+            raise HTTPException(status_code=404, detail="Post not found")
+        return FastJSONResponse(archived)
     
     images = db.query(PostImage).filter(PostImage.post_id == post.id).all()
     post.images = images
+    post.videos = db.query(PostVideo).filter(PostVideo.post_id == post.id).all()
     
     return post
 
@@ -892,15 +3594,19 @@ async def get_post(post_id: int, db: Session = Depends(get_db)):
 # Delete a post
 # ------------------------------
 @app.delete("/posts/{post_id}")
-async def delete_post(post_id: int, db: Session = Depends(get_db)):
+async def delete_post(post_id: int, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     """
     Xóa post:
     - Nếu post chưa đăng, cố gắng remove job scheduler
-    - Xóa luôn bản ghi PostImage (và không xóa file ảnh trên disk ở đây,
-      tuy nhiên bạn có thể thêm xóa file nếu muốn)
+    - Xóa luôn bản ghi PostImage / PostVideo và giảm ref_count của file ảnh / video;
+      file không còn ai dùng sẽ được sweep_orphan_media xóa sau thời gian chờ
+    - Bài chưa đăng có ảnh đã pre-stage: xóa các ảnh unpublished đó trên Facebook (chạy nền)
+    - Bài đã archive: xóa khỏi DB archive
     """
     post = db.query(Post).filter(Post.id == post_id).first()
     if not post:
+        if delete_archived_post(db, post_id):
+            return {"message": "Post deleted successfully"}
         raise HTTPException(status_code=404, detail="Post not found")
     
     # Remove scheduled job nếu chưa posted
@@ -911,31 +3617,36 @@ async def delete_post(post_id: int, db: Session = Depends(get_db)):
             # job có thể không tồn tại -> ignore
             pass
     
-    # XÓA PostImage records (và nếu bạn muốn xóa cả file actual, thêm os.remove ở đây)
+    # XÓA PostImage / PostVideo records (file trên disk do GC xử lý, không xóa trực tiếp ở đây)
     images = db.query(PostImage).filter(PostImage.post_id == post_id).all()
+    videos = db.query(PostVideo).filter(PostVideo.post_id == post_id).all()
+    staged_photo_ids = [img.facebook_photo_id for img in images if img.facebook_photo_id] if not post.posted else []
+    token = get_page_token(db, post) if staged_photo_ids else None
+    adjust_media_refs(db, [img.image_path for img in images] + [v.video_path for v in videos], -1)
     for img in images:
-        # Nếu bạn muốn xóa file local: uncomment 2 dòng dưới
-        # if img.image_path and os.path.exists(img.image_path):
-        #     os.remove(img.image_path)
         db.delete(img)
+    for video in videos:
+        db.delete(video)
+    db.query(PostMetric).filter(PostMetric.post_id == post_id).delete(synchronize_session=False)
     
     db.delete(post)
     db.commit()
+    if token:
+        background_tasks.add_task(discard_staged_photos, token.access_token, staged_photo_ids)
     return {"message": "Post deleted successfully"}
 
 # ------------------------------
 # Facebook tokens endpoints
 # ------------------------------
 @app.post("/facebook-tokens/", response_model=FacebookTokenResponse)
-async def create_facebook_token(token: FacebookTokenCreate, db: Session = Depends(get_db)):
+async def create_facebook_token(token: FacebookTokenCreate, db: Session = Depends(get_db),
+                                user_id: int = Depends(get_current_user_id)):
     """
-    Thêm token Facebook cho user:
+    Thêm token Facebook cho user (tenant lấy từ header X-User-Id):
     - Verify token bằng get_page_info
     - Lưu token + page_id vào DB
     """
-    # Demo: user_id = 1
-    user_id = 1
-    
+
     # Verify token + page id trực tiếp với Facebook
     try:
         page_info = FacebookAPI.get_page_info(token.access_token, token.page_id)
@@ -958,23 +3669,23 @@ async def create_facebook_token(token: FacebookTokenCreate, db: Session = Depend
     return db_token
 
 @app.get("/facebook-tokens/", response_model=List[FacebookTokenResponse])
-async def get_facebook_tokens(db: Session = Depends(get_db)):
+async def get_facebook_tokens(db: Session = Depends(get_db), user_id: int = Depends(get_current_user_id)):
     """
-    Lấy danh sách token đã lưu (thực tế có thể cần filter theo user)
+    Lấy danh sách token đã lưu của tenant hiện tại
     """
-    tokens = db.query(FacebookToken).all()
+    tokens = db.query(FacebookToken).filter(FacebookToken.user_id == user_id).all()
     return tokens
 
 # ------------------------------
 # Post immediately (bypass scheduler)
 # ------------------------------
 @app.post("/posts/{post_id}/post-now")
-async def post_now(post_id: int, db: Session = Depends(get_db)):
+def post_now(post_id: int, db: Session = Depends(get_db)):
     """
     Endpoint đăng bài ngay lập tức (bỏ qua scheduler).
-    - Tải post, images, token.
+    - Tải post, token; claim bài (chuyển sang publishing).
     - Gọi Facebook API để đăng bài.
-    - Cập nhật trạng thái post trong DB (posted=True).
+    - Cập nhật trạng thái post trong DB (posted=True) hoặc hẹn retry nếu lỗi.
     """
     
     # 1. Tải Post từ DB
@@ -987,20 +3698,11 @@ async def post_now(post_id: int, db: Session = Depends(get_db)):
 
     # 2. Tải Facebook Token
     # Demo: dùng token đầu tiên của user (user_id = 1)
-    token = db.query(FacebookToken).filter(FacebookToken.user_id == post.user_id).first()
+    token = get_page_token(db, post)
     if not token:
         raise HTTPException(status_code=400, detail="Facebook token not configured for this user.")
 
-    # 3. Tải Ảnh kèm Post
-    images = db.query(PostImage).filter(PostImage.post_id == post_id).all()
-    image_data = []
-    for img in images:
-        image_data.append({
-            'image_url': img.image_url,
-            'image_path': img.image_path
-        })
-
-    # 4. Remove job khỏi Scheduler (nếu nó đang chờ đăng)
+    # 3. Remove job khỏi Scheduler (nếu nó đang chờ đăng)
     try:
         # Nếu bài đang chờ schedule, ta cần hủy job đó
         scheduler.remove_job(f"post_{post_id}")
@@ -1009,22 +3711,15 @@ async def post_now(post_id: int, db: Session = Depends(get_db)):
         # Bỏ qua nếu job không tồn tại
         pass
 
-    # 5. Gọi Facebook API để đăng bài
+    # 4. Claim bài (cho phép đăng lại bài failed); nếu worker khác đang đăng -> 409
+    if not claim_post(db, post_id, allow_failed=True):
+        raise HTTPException(status_code=409, detail="Post is being published by another worker.")
+
+    # 5. Gọi Facebook API để đăng bài (ảnh đã checkpoint ở lần trước không upload lại)
+    #    + cập nhật trạng thái posted
     try:
-        result = FacebookAPI.post_to_facebook_with_images(
-            token.access_token,
-            token.page_id,
-            post.content,
-            image_data
-        )
-        
-        # 6. Cập nhật trạng thái sau khi đăng thành công
-        post.posted = True
-        post.facebook_post_id = result.get("post_id")
-        # Sử dụng timezone.utc cho tính nhất quán
-        post.posted_at = datetime.now(timezone.utc)
-        
-        db.commit()
+        result = publish_post(db, post, token)
+
         # --- BƯỚC MỚI: GỬI EMAIL THÔNG BÁO ---
         send_email_notification(
             post.id, 
@@ -1040,15 +3735,754 @@ async def post_now(post_id: int, db: Session = Depends(get_db)):
         }
 
     except HTTPException as e:
-        # Bắt lỗi HTTP từ FacebookAPI (đã được custom)
-        db.rollback()
+        # Bắt lỗi HTTP từ FacebookAPI (đã được custom); hẹn retry / dead-letter
+        record_publish_failure(db, post_id, e)
         raise e
     
     except Exception as e:
         # Xử lý các lỗi khác (ví dụ: Network, Data, etc.)
-        db.rollback()
+        record_publish_failure(db, post_id, e)
         print("="*50)
         print(f"LỖI NGHIÊM TRỌNG KHI ĐĂNG BÀI NGAY LẬP TỨC:")
         traceback.print_exc()
         print("="*50)
-        raise HTTPException(status_code=500, detail=f"Internal error during Facebook posting: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Internal error during Facebook posting: {str(e)}")
+
+# ------------------------------
+# Create + publish (202 Accepted, Idempotency-Key)
+# ------------------------------
+# Tạo bài và trả 202 ngay, việc đăng (upload Facebook, gửi email) do worker nền làm:
+# - process có scheduler: đánh thức dispatcher (bài đi qua hàng đợi chia lượt theo tenant)
+# - worker web không chạy scheduler: chạy post_scheduled_content sau khi trả response
+#   (claim_post đảm bảo bài không bị đăng 2 lần nếu scheduler ở process khác cũng nhận bài)
+# Job id chính là post id; client theo dõi qua status_url.
+IDEMPOTENCY_KEY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", 24))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+
+def _publish_job_response(db: Session, post_id: int, replayed: bool = False) -> Response:
+    rows = db.query(*POST_COLUMNS).filter(Post.id == post_id).all()
+    post = serialize_posts(db, rows)[0]
+    status_url = f"/posts/{post_id}/status"
+    headers = {"Location": status_url}
+    if replayed:
+        headers["Idempotent-Replayed"] = "true"
+    return FastJSONResponse(
+        {"job_id": post_id, "status": post["status"], "status_url": status_url, "post": post},
+        status_code=status.HTTP_202_ACCEPTED,
+        headers=headers,
+    )
+
+
+def _find_idempotency_key(db: Session, user_id: int, key: str) -> Optional[IdempotencyKey]:
+    return (
+        db.query(IdempotencyKey)
+        .filter(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key)
+        .first()
+    )
+
+
+def _replay_idempotent_request(db: Session, record: IdempotencyKey, request_hash: str) -> Response:
+    if record.request_hash != request_hash:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Idempotency-Key was already used with a different request body.",
+        )
+    if not db.query(Post.id).filter(Post.id == record.post_id).first():
+        # Bài của key này đã bị xóa -> không tạo lại ngầm
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Post for this Idempotency-Key was deleted.")
+    return _publish_job_response(db, record.post_id, replayed=True)
+
+
+@app.post("/posts/create-and-publish", status_code=status.HTTP_202_ACCEPTED)
+async def create_and_publish_post(
+    post: PostPublishRequest,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    user_id: int = Depends(get_current_user_id),
+    idempotency_key: Optional[str] = Header(None),
+):
+    """
+    Tạo bài và đăng ngay ở nền (thay cho POST /posts/ + POST /posts/{id}/post-now):
+    - commit bài (pending, đến hạn ngay) rồi trả 202: job_id (= post id), status_url, post
+    - header Idempotency-Key: gửi lại cùng key + cùng body -> trả lại đúng job cũ
+      (không tạo bài trùng, không đăng 2 lần); cùng key nhưng body khác -> 422
+    """
+    validate_post_media(post.images, post.videos)
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail="Invalid Idempotency-Key header.")
+
+    request_hash = hashlib.sha256(
+        json.dumps(post.model_dump(mode="json"), sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+    if idempotency_key is not None:
+        record = _find_idempotency_key(db, user_id, idempotency_key)
+        if record:
+            return _replay_idempotent_request(db, record, request_hash)
+
+    now = datetime.utcnow()
+    db_post = Post(
+        user_id=user_id,
+        content=post.content,
+        scheduled_time=now,
+        status=PostStatus.PENDING,
+        attempt_count=0,
+        next_attempt_at=now
+    )
+    db.add(db_post)
+    db.flush()
+    add_post_media(db, db_post.id, post.images, post.videos)
+    if idempotency_key is not None:
+        db.add(IdempotencyKey(
+            user_id=user_id,
+            key=idempotency_key,
+            request_hash=request_hash,
+            post_id=db_post.id,
+        ))
+    try:
+        # Bài, ảnh và key nằm trong cùng 1 transaction
+        db.commit()
+    except IntegrityError:
+        # Request trùng key đến cùng lúc và đã commit trước -> trả lại job của request đó
+        db.rollback()
+        record = _find_idempotency_key(db, user_id, idempotency_key) if idempotency_key else None
+        if not record:
+            raise
+        return _replay_idempotent_request(db, record, request_hash)
+
+    if scheduler.running:
+        wake_dispatcher()
+    else:
+        background_tasks.add_task(post_scheduled_content, db_post.id)
+    return _publish_job_response(db, db_post.id)
+
+
+@app.get("/posts/{post_id}/status")
+async def get_post_status(post_id: int, db: Session = Depends(get_db)):
+    """Trạng thái đăng của 1 bài / job (status_url của create-and-publish)."""
+    fields = ("id", "status", "posted", "attempt_count", "last_error",
+              "next_attempt_at", "facebook_post_id", "posted_at")
+    row = db.query(*(getattr(Post, field) for field in fields)).filter(Post.id == post_id).first()
+    if row:
+        return FastJSONResponse(dict(row._mapping))
+    archived = load_archived_post(post_id)
+    if archived is None:
+        raise HTTPException(status_code=404, detail="Post not found")
+    return FastJSONResponse({field: archived.get(field) for field in fields})
+
+
+def cleanup_idempotency_keys():
+    """Job định kỳ: xóa Idempotency-Key cũ hơn IDEMPOTENCY_KEY_TTL_HOURS (theo index created_at)."""
+    cutoff = datetime.utcnow() - timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+    db = SessionLocal()
+    try:
+        deleted = (
+            db.query(IdempotencyKey)
+            .filter(IdempotencyKey.created_at < cutoff)
+            .delete(synchronize_session=False)
+        )
+        db.commit()
+    finally:
+        db.close()
+    if deleted:
+        print(f"Đã xóa {deleted} Idempotency-Key hết hạn.")
+    return deleted
+
+
+scheduler.add_job(
+    cleanup_idempotency_keys,
+    "interval",
+    hours=1,
+    id="cleanup_idempotency_keys",
+    replace_existing=True,
+    max_instances=1,
+    coalesce=True,
+)
+
+# ------------------------------
+# Dead-letter: bài đăng thất bại
+# ------------------------------
+@app.get("/failed-posts/", response_model=List[PostResponse])
+async def get_failed_posts(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+    """
+    Danh sách bài đã hết lượt retry (status = failed), kèm attempt_count + last_error.
+    """
+    rows = (
+        db.query(*POST_COLUMNS)
+        .filter(Post.status == PostStatus.FAILED)
+        .order_by(Post.id)
+        .offset(skip)
+        .limit(limit)
+        .all()
+    )
+    return FastJSONResponse(serialize_posts(db, rows))
+
+
+@app.post("/failed-posts/redrive")
+async def redrive_failed_posts(request: RedriveRequest, db: Session = Depends(get_db)):
+    """
+    Đưa các bài failed về lại hàng đợi (pending, attempt_count = 0, đến hạn ngay).
+    dispatch_due_posts sẽ đăng dần (chia lượt theo tenant, PUBLISH_BATCH_SIZE bài mỗi lượt).
+    """
+    query = db.query(Post).filter(Post.status == PostStatus.FAILED)
+    if request.post_ids is not None:
+        query = query.filter(Post.id.in_(request.post_ids))
+    redriven = query.update(
+        {
+            Post.status: PostStatus.PENDING,
+            Post.attempt_count: 0,
+            Post.next_attempt_at: datetime.utcnow(),
+        },
+        synchronize_session=False,
+    )
+    db.commit()
+    if redriven:
+        wake_dispatcher()
+    return {"message": "Failed posts re-queued", "redriven": redriven}
+
+# ------------------------------
+# Export (NDJSON / CSV, streaming)
+# ------------------------------
+# Đọc theo lô keyset (id > id cuối của lô trước, ORDER BY id) thay vì OFFSET, ảnh / video của
+# cả lô lấy bằng 1 query IN (serialize_posts). Mỗi lô được encode và gửi đi ngay:
+# bộ nhớ chỉ giữ 1 lô dù export hàng triệu bài, và byte đầu tiên ra ngay sau lô đầu tiên.
+# Mỗi lô là 1 query ngắn nên không giữ transaction / cursor mở suốt quá trình export.
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+EXPORT_POST_COLUMNS = POST_COLUMNS + (Post.user_id, Post.page_id)
+ARCHIVE_EXPORT_POST_COLUMNS = _archive_columns(EXPORT_POST_COLUMNS)
+EXPORT_CSV_POST_FIELDS = (
+    "id", "user_id", "page_id", "content", "scheduled_time", "status", "posted",
+    "facebook_post_id", "created_at", "posted_at", "attempt_count", "last_error",
+    "next_attempt_at",
+)
+EXPORT_CSV_FIELDS = EXPORT_CSV_POST_FIELDS + (
+    "image_count", "image_paths", "image_urls", "facebook_photo_ids",
+    "video_paths", "facebook_video_ids",
+)
+# Nhiều giá trị (vd. nhiều ảnh) trong 1 ô CSV được nối bằng ký tự này
+EXPORT_CSV_LIST_SEPARATOR = "|"
+
+
+def _export_filter_clauses(posts_table, filters: dict) -> list:
+    """Điều kiện lọc export trên bảng posts hoặc archived_posts."""
+    clauses = []
+    if filters.get("status") is not None:
+        clauses.append(posts_table.c.status == filters["status"])
+    if filters.get("date_from") is not None:
+        clauses.append(posts_table.c.scheduled_time >= to_utc_naive(filters["date_from"]))
+    if filters.get("date_to") is not None:
+        clauses.append(posts_table.c.scheduled_time < to_utc_naive(filters["date_to"]))
+    return clauses
+
+
+def _iter_export_source(db: Session, columns, filters: dict, archived: bool, batch_size: int):
+    post_id = columns[0]
+    clauses = _export_filter_clauses(post_id.table, filters)
+    last_id = 0
+    while True:
+        rows = (
+            db.query(*columns)
+            .filter(*clauses, post_id > last_id)
+            .order_by(post_id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield serialize_posts(db, rows, archived=archived)
+        # Không giữ object nào trong identity map giữa các lô
+        db.expunge_all()
+
+
+def iter_export_batches(filters: dict, batch_size: int = None):
+    """
+    Sinh từng lô post (list dict giống GET /posts/, thêm user_id, page_id):
+    bài đã archive trước (bài cũ), sau đó bài trong bảng hot, mỗi phần theo thứ tự id.
+    """
+    batch_size = batch_size or EXPORT_BATCH_SIZE
+    archive_db = get_archive_session()
+    if archive_db is not None:
+        try:
+            yield from _iter_export_source(archive_db, ARCHIVE_EXPORT_POST_COLUMNS, filters, True, batch_size)
+        finally:
+            archive_db.close()
+    db = SessionLocal()
+    try:
+        yield from _iter_export_source(
+            db, tuple(column.expression for column in EXPORT_POST_COLUMNS), filters, False, batch_size
+        )
+    finally:
+        db.close()
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _csv_list(items, key):
+    return EXPORT_CSV_LIST_SEPARATOR.join(str(item[key]) for item in items if item.get(key))
+
+
+def iter_export_ndjson(filters):
+    for posts in iter_export_batches(filters):
+        yield b"".join(dumps_json(post) + b"\n" for post in posts)
+
+
+def iter_export_csv(filters):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_CSV_FIELDS)
+    # Header gửi ngay (kèm BOM để Excel đọc đúng UTF-8 tiếng Việt)
+    yield ("\ufeff" + buffer.getvalue()).encode("utf-8")
+    for posts in iter_export_batches(filters):
+        buffer.seek(0)
+        buffer.truncate()
+        for post in posts:
+            images, videos = post["images"], post["videos"]
+            writer.writerow([_csv_value(post[field]) for field in EXPORT_CSV_POST_FIELDS] + [
+                len(images),
+                _csv_list(images, "image_path"),
+                _csv_list(images, "image_url"),
+                _csv_list(images, "facebook_photo_id"),
+                _csv_list(videos, "video_path"),
+                _csv_list(videos, "facebook_video_id"),
+            ])
+        yield buffer.getvalue().encode("utf-8")
+
+
+@app.get("/export/posts")
+async def export_posts(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    post_status: Optional[str] = Query(None, alias="status"),
+    date_from: Optional[datetime] = Query(None, description="scheduled_time >= date_from"),
+    date_to: Optional[datetime] = Query(None, description="scheduled_time < date_to"),
+):
+    """
+    Export toàn bộ bài (kèm ảnh / video) dạng stream:
+    - format=ndjson: mỗi dòng 1 JSON (cấu trúc như GET /posts/, thêm user_id, page_id)
+    - format=csv: mỗi dòng 1 bài, danh sách ảnh / video nối bằng "|"
+    - lọc tùy chọn: status, date_from, date_to (theo scheduled_time)
+    - gồm cả bài đã archive
+    """
+    filters = {"status": post_status, "date_from": date_from, "date_to": date_to}
+
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    if format == "csv":
+        body, media_type = iter_export_csv(filters), "text/csv"
+    else:
+        body, media_type = iter_export_ndjson(filters), "application/x-ndjson"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="posts-{stamp}.{format}"'},
+    )
+
+# ------------------------------
+# Per-tenant dispatch metrics
+# ------------------------------
+@app.get("/metrics/tenants")
+async def get_tenant_metrics(db: Session = Depends(get_db)):
+    """
+    Độ trễ đăng theo tenant, để kiểm tra tenant nặng không làm chậm tenant khác:
+    - due_now, oldest_due_seconds: backlog hiện tại (đọc từ DB)
+    - dispatched, inflight, lag_*_seconds: độ trễ từ lúc bài tới hạn tới lúc được đưa vào
+      xử lý, tính trên TENANT_LAG_SAMPLES bài gần nhất (chỉ có ở process chạy scheduler)
+    """
+    now = datetime.utcnow()
+    backlog = {
+        row.user_id: row
+        for row in db.query(
+            Post.user_id,
+            func.count(Post.id).label("due"),
+            func.min(Post.next_attempt_at).label("oldest"),
+        )
+        .filter(*_due_post_filter(now))
+        .group_by(Post.user_id)
+    }
+    with _tenant_stats_lock:
+        dispatch = {
+            user_id: {
+                "dispatched": stats["dispatched"],
+                "inflight": stats["inflight"],
+                "max_lag": stats["max_lag"],
+                "lags": sorted(stats["lags"]),
+            }
+            for user_id, stats in _tenant_dispatch_stats.items()
+        }
+
+    tenants = []
+    for user_id in sorted(set(backlog) | set(dispatch), key=lambda t: (t is None, t)):
+        row = backlog.get(user_id)
+        stats = dispatch.get(user_id, {"dispatched": 0, "inflight": 0, "max_lag": 0.0, "lags": []})
+        lags = stats["lags"]
+        tenants.append({
+            "user_id": user_id,
+            "weight": tenant_weight(user_id),
+            "max_concurrency": TENANT_MAX_CONCURRENCY,
+            "due_now": row.due if row else 0,
+            "oldest_due_seconds": round((now - row.oldest).total_seconds(), 1) if row else 0.0,
+            "dispatched": stats["dispatched"],
+            "inflight": stats["inflight"],
+            "lag_avg_seconds": round(sum(lags) / len(lags), 3) if lags else None,
+            "lag_p95_seconds": round(lags[min(len(lags) - 1, int(len(lags) * 0.95))], 3) if lags else None,
+            "lag_max_seconds": round(stats["max_lag"], 3) if lags else None,
+        })
+    return {"tenants": tenants}
+
+# ------------------------------
+# Admission control metrics
+# ------------------------------
+@app.get("/metrics/admission")
+async def get_admission_metrics():
+    """Trạng thái giới hạn đồng thời theo nhóm endpoint (của process đang trả lời)."""
+    return {
+        "pid": os.getpid(),
+        "queue_timeout_seconds": ADMISSION_QUEUE_TIMEOUT_SECONDS,
+        "retry_after_seconds": ADMISSION_RETRY_AFTER_SECONDS,
+        "classes": {name: gate.snapshot() for name, gate in admission_gates.items()},
+    }
+
+# ------------------------------
+# Publish-time precision
+# ------------------------------
+@app.get("/metrics/publish-precision")
+async def get_publish_precision(hours: int = Query(24, ge=1, le=24 * 30), db: Session = Depends(get_db)):
+    """
+    Độ lệch giờ đăng (posted_at - scheduled_time, giây) của các bài đăng trong `hours` giờ gần nhất:
+    - first_attempt: bài đăng được ngay lần đầu (phản ánh độ trễ của dispatcher + upload)
+    - all: tính cả bài phải retry
+    """
+    since = datetime.utcnow() - timedelta(hours=hours)
+    rows = (
+        db.query(Post.publish_lag_seconds, Post.attempt_count)
+        .filter(Post.status == PostStatus.POSTED, Post.posted_at >= since, Post.publish_lag_seconds.isnot(None))
+        .all()
+    )
+
+    def summarize(lags):
+        if not lags:
+            return {"count": 0, "avg": None, "p50": None, "p95": None, "max": None}
+        lags = sorted(lags)
+        pick = lambda q: round(lags[min(len(lags) - 1, int(len(lags) * q))], 3)
+        return {
+            "count": len(lags),
+            "avg": round(sum(lags) / len(lags), 3),
+            "p50": pick(0.5),
+            "p95": pick(0.95),
+            "max": round(lags[-1], 3),
+        }
+
+    return {
+        "hours": hours,
+        "prestage_minutes": PRESTAGE_MINUTES,
+        "first_attempt": summarize([row.publish_lag_seconds for row in rows if (row.attempt_count or 0) <= 1]),
+        "all": summarize([row.publish_lag_seconds for row in rows]),
+    }
+
+# ------------------------------
+# Publishing statistics
+# ------------------------------
+@app.get("/stats/publishing")
+async def get_publishing_stats(
+    granularity: str = Query("day", pattern="^(hour|day)$"),
+    page_id: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Thống kê đăng bài theo giờ / ngày (UTC), chỉ đọc bảng rollup publish_stats.
+    Trả về từng bucket + tổng cộng trong khoảng thời gian.
+    """
+    query = db.query(
+        PublishStat.page_id, PublishStat.bucket_start, PublishStat.publishes,
+        PublishStat.failures, PublishStat.images,
+    ).filter(PublishStat.granularity == granularity)
+    if page_id is not None:
+        query = query.filter(PublishStat.page_id == page_id)
+    if date_from is not None:
+        query = query.filter(PublishStat.bucket_start >= stats_bucket_start(date_from, granularity))
+    if date_to is not None:
+        query = query.filter(PublishStat.bucket_start < to_utc_naive(date_to))
+
+    buckets = [dict(row._mapping) for row in query.order_by(PublishStat.bucket_start, PublishStat.page_id)]
+    totals = {
+        "publishes": sum(b["publishes"] for b in buckets),
+        "failures": sum(b["failures"] for b in buckets),
+        "images": sum(b["images"] for b in buckets),
+    }
+    return FastJSONResponse({"granularity": granularity, "buckets": buckets, "totals": totals})
+
+
+@app.post("/stats/publishing/rebuild", status_code=status.HTTP_202_ACCEPTED)
+async def rebuild_publishing_stats(background_tasks: BackgroundTasks):
+    """Chạy backfill rebuild_publish_stats ở background (tính lại rollup từ lịch sử)."""
+    background_tasks.add_task(rebuild_publish_stats)
+    return {"message": "Rebuilding publishing statistics"}
+
+# ------------------------------
+# Engagement insights (đọc từ post_metrics, không gọi Graph API)
+# ------------------------------
+METRIC_COLUMNS = (
+    PostMetric.post_id, PostMetric.facebook_post_id, PostMetric.reactions, PostMetric.comments,
+    PostMetric.shares, PostMetric.reach, PostMetric.fetched_at, PostMetric.next_refresh_at,
+    PostMetric.last_error,
+)
+
+
+@app.get("/posts/{post_id}/insights")
+async def get_post_insights(post_id: int, db: Session = Depends(get_db)):
+    """Số liệu tương tác gần nhất của 1 bài (do collect_post_insights cập nhật)."""
+    row = db.query(*METRIC_COLUMNS).filter(PostMetric.post_id == post_id).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="No insights for this post yet")
+    return FastJSONResponse(dict(row._mapping))
+
+
+@app.get("/insights/posts")
+async def list_post_insights(skip: int = 0, limit: int = Query(100, le=1000), db: Session = Depends(get_db)):
+    """Số liệu tương tác của nhiều bài (mới nhất trước)."""
+    rows = (
+        db.query(*METRIC_COLUMNS)
+        .order_by(PostMetric.post_id.desc())
+        .offset(skip)
+        .limit(limit)
+        .all()
+    )
+    return FastJSONResponse([dict(row._mapping) for row in rows])
+
+# ------------------------------
+# FULL-TEXT SEARCH (posts.content)
+# ------------------------------
+# - SQLite: bảng ảo FTS5 posts_fts (external content = posts), đồng bộ bằng trigger
+#   khi insert / update / delete -> create_post, delete_post không cần làm gì thêm.
+#   Tokenizer unicode61 remove_diacritics: tìm "ao thun" vẫn ra "áo thun".
+# - PostgreSQL: index GIN trên to_tsvector('simple', content), luôn tự đồng bộ.
+# - DB khác / SQLite không có FTS5: fallback LIKE (không xếp hạng).
+SEARCH_SNIPPET_START = "<mark>"
+SEARCH_SNIPPET_END = "</mark>"
+SEARCH_MAX_LIMIT = 100
+# Từ khóa quá phổ biến (khớp hàng trăm nghìn bài) thì chấm điểm bm25 cho tất cả sẽ chậm:
+# chỉ xếp hạng trong SEARCH_RANK_WINDOW bài khớp mới nhất (0 = không giới hạn).
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", 5000))
+_search_backend = "like"
+
+_SQLITE_FTS_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS posts_fts_ai AFTER INSERT ON posts BEGIN "
+    "INSERT INTO posts_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS posts_fts_ad AFTER DELETE ON posts BEGIN "
+    "INSERT INTO posts_fts(posts_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS posts_fts_au AFTER UPDATE OF content ON posts BEGIN "
+    "INSERT INTO posts_fts(posts_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO posts_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+_SQLITE_FTS_SETUP = [
+    "CREATE VIRTUAL TABLE posts_fts USING fts5("
+    "content, content='posts', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    *_SQLITE_FTS_TRIGGERS,
+    # Index dữ liệu đã có trước khi bật tìm kiếm
+    "INSERT INTO posts_fts(posts_fts) VALUES ('rebuild')",
+]
+
+
+def init_search_index():
+    """Tạo index full-text (nếu chưa có) và chọn backend tìm kiếm theo dialect."""
+    global _search_backend
+    dialect = engine.dialect.name
+    try:
+        with engine.begin() as conn:
+            if dialect == "sqlite":
+                exists = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'posts_fts'"
+                )).first()
+                if not exists:
+                    for statement in _SQLITE_FTS_SETUP:
+                        conn.execute(text(statement))
+                    print("SEARCH: đã tạo index FTS5 posts_fts.")
+                else:
+                    # Trigger mất theo bảng posts khi bảng được dựng lại (migrate_schema)
+                    for statement in _SQLITE_FTS_TRIGGERS:
+                        conn.execute(text(statement))
+                _search_backend = "fts5"
+            elif dialect == "postgresql":
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_posts_content_fts ON posts "
+                    "USING GIN (to_tsvector('simple', coalesce(content, '')))"
+                ))
+                _search_backend = "postgres"
+    except SQLAlchemyError as e:
+        print(f"CẢNH BÁO: Không tạo được index full-text ({e}). Tìm kiếm dùng LIKE.")
+        _search_backend = "like"
+
+
+def _encode_search_cursor(rank: float, post_id: int) -> str:
+    raw = json.dumps([rank, post_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_search_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        rank, post_id = json.loads(base64.urlsafe_b64decode(padded))
+        return float(rank), int(post_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _fts5_match_expression(q: str) -> str:
+    """
+    Chuyển chuỗi người dùng nhập thành biểu thức MATCH an toàn:
+    mỗi từ được đặt trong "..." (AND ngầm định), từ cuối tìm theo tiền tố.
+    """
+    tokens = re.findall(r"\w+", q)
+    if not tokens:
+        raise HTTPException(status_code=400, detail="Search query must contain at least one word")
+    terms = [f'"{token}"' for token in tokens]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def _search_filters(posted: Optional[bool], date_from: Optional[datetime], date_to: Optional[datetime]):
+    clauses, params = [], {}
+    if posted is not None:
+        clauses.append("p.posted = :posted")
+        params["posted"] = posted
+    if date_from is not None:
+        clauses.append("p.scheduled_time >= :date_from")
+        params["date_from"] = to_utc_naive(date_from)
+    if date_to is not None:
+        clauses.append("p.scheduled_time < :date_to")
+        params["date_to"] = to_utc_naive(date_to)
+    return clauses, params
+
+
+def search_post_ids(db: Session, q: str, posted: Optional[bool], date_from: Optional[datetime],
+                    date_to: Optional[datetime], limit: int, after=None):
+    """
+    Trả (rows, truncated):
+    - rows: list (id, rank, snippet) đã xếp hạng (rank nhỏ = liên quan hơn), tối đa limit + 1 dòng
+      (dòng thừa để biết còn trang sau). after = (rank, id) của dòng cuối trang trước.
+    - truncated: True nếu còn bài khớp cũ hơn SEARCH_RANK_WINDOW không được xếp hạng
+    """
+    post_filters, params = _search_filters(posted, date_from, date_to)
+    params["limit"] = limit + 1
+    truncated = False
+
+    if _search_backend == "fts5":
+        params["match"] = _fts5_match_expression(q)
+        inner = (
+            "SELECT p.id AS id, bm25(posts_fts) AS rank, "
+            f"snippet(posts_fts, 0, '{SEARCH_SNIPPET_START}', '{SEARCH_SNIPPET_END}', '…', 16) AS snippet "
+            "FROM posts_fts JOIN posts p ON p.id = posts_fts.rowid "
+            "WHERE posts_fts MATCH :match"
+        )
+        if SEARCH_RANK_WINDOW > 0:
+            # rowid của bài khớp (đã qua bộ lọc posted / ngày) thứ SEARCH_RANK_WINDOW tính từ mới nhất;
+            # duyệt doclist theo rowid rất rẻ, không phải chấm bm25
+            matched = (
+                "FROM posts_fts JOIN posts p ON p.id = posts_fts.rowid WHERE posts_fts MATCH :match"
+                + "".join(" AND " + clause for clause in post_filters)
+            )
+            threshold = db.execute(text(
+                f"SELECT posts_fts.rowid {matched} ORDER BY posts_fts.rowid DESC LIMIT 1 OFFSET :offset"
+            ), {**params, "offset": SEARCH_RANK_WINDOW - 1}).scalar()
+            if threshold is not None:
+                inner += " AND posts_fts.rowid >= :min_rowid"
+                params["min_rowid"] = threshold
+                truncated = db.execute(text(
+                    f"SELECT 1 {matched} AND posts_fts.rowid < :min_rowid LIMIT 1"
+                ), params).first() is not None
+    elif _search_backend == "postgres":
+        params["q"] = q
+        inner = (
+            "SELECT p.id AS id, "
+            "-ts_rank_cd(to_tsvector('simple', coalesce(p.content, '')), plainto_tsquery('simple', :q)) AS rank, "
+            "p.content AS snippet "
+            "FROM posts p "
+            "WHERE to_tsvector('simple', coalesce(p.content, '')) @@ plainto_tsquery('simple', :q)"
+        )
+    else:
+        params["like"] = f"%{q}%"
+        inner = "SELECT p.id AS id, 0.0 AS rank, p.content AS snippet FROM posts p WHERE p.content LIKE :like"
+
+    # Bộ lọc posted / ngày nằm trong subquery; điều kiện cursor áp lên rank đã tính
+    if post_filters:
+        inner += " AND " + " AND ".join(post_filters)
+    sql = f"SELECT id, rank, snippet FROM ({inner}) ranked"
+    if after is not None:
+        sql += " WHERE rank > :after_rank OR (rank = :after_rank AND id > :after_id)"
+        params["after_rank"], params["after_id"] = after
+    sql += " ORDER BY rank, id LIMIT :limit"
+    rows = db.execute(text(sql), params).all()
+
+    if _search_backend == "postgres" and rows:
+        # ts_headline tốn CPU -> chỉ tính cho các dòng của trang hiện tại
+        headline_sql = text(
+            "SELECT ts_headline('simple', :content, plainto_tsquery('simple', :q), "
+            f"'StartSel={SEARCH_SNIPPET_START},StopSel={SEARCH_SNIPPET_END},MaxWords=24,MinWords=8')"
+        )
+        rows = [
+            (row.id, row.rank, db.execute(headline_sql, {"content": row.snippet or "", "q": q}).scalar())
+            for row in rows
+        ]
+    elif _search_backend == "like":
+        rows = [(row.id, row.rank, (row.snippet or "")[:200]) for row in rows]
+    else:
+        rows = [(row.id, row.rank, row.snippet) for row in rows]
+    return rows, truncated
+
+
+@app.get("/search/posts")
+async def search_posts(
+    q: str = Query(..., min_length=1, description="Từ khóa tìm trong nội dung bài"),
+    posted: Optional[bool] = None,
+    date_from: Optional[datetime] = Query(None, description="scheduled_time >= date_from"),
+    date_to: Optional[datetime] = Query(None, description="scheduled_time < date_to"),
+    limit: int = Query(20, ge=1, le=SEARCH_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Tìm bài theo nội dung (full-text), xếp hạng theo độ liên quan:
+    - mỗi kết quả gồm thông tin post (như GET /posts/) + snippet (từ khớp bọc <mark>) + rank
+    - phân trang bằng cursor: truyền next_cursor của trang trước
+    - truncated = true: từ khóa khớp quá nhiều bài, chỉ SEARCH_RANK_WINDOW bài mới nhất được xếp hạng
+      (hết trang không có nghĩa là hết bài khớp; thêm bộ lọc ngày / từ khóa để thu hẹp)
+    """
+    after = _decode_search_cursor(cursor) if cursor else None
+    hits, truncated = search_post_ids(db, q, posted, date_from, date_to, limit, after)
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+
+    rows = db.query(*POST_COLUMNS).filter(Post.id.in_([hit[0] for hit in hits])).all() if hits else []
+    posts_by_id = {post["id"]: post for post in serialize_posts(db, rows)}
+    results = []
+    for post_id, rank, snippet in hits:
+        post = posts_by_id.get(post_id)
+        if post is None:
+            continue
+        post["snippet"] = snippet
+        post["rank"] = rank
+        results.append(post)
+
+    next_cursor = _encode_search_cursor(hits[-1][1], hits[-1][0]) if has_more else None
+    return FastJSONResponse({
+        "results": results,
+        "next_cursor": next_cursor,
+        "truncated": truncated,
+        "rank_window": SEARCH_RANK_WINDOW if truncated else None,
+    })
+
+
+# Mốc kết thúc import (dùng cho báo cáo thời gian khởi động trong lifespan)
+_LIFESPAN_READY = time.perf_counter()
+
+if __name__ == "__main__":
+    # Chạy trực tiếp: python main.py
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -132,37 +132,43 @@ const CreatePost = ({ onPostCreated, facebookTokens }) => {
 
     setLoading(true);
 
-    try {
-      // First create the post
-      const createResponse = await fetch(`${API_BASE_URL}/posts/`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          ...formData,
-          scheduled_time: new Date()
-        }),
-      });
+    // Cùng 1 key cho mọi lần gửi lại của lần bấm này -> backend không tạo / đăng trùng
+    const idempotencyKey = window.crypto?.randomUUID
+      ? window.crypto.randomUUID()
+      : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    const request = () => fetch(`${API_BASE_URL}/posts/create-and-publish`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'Idempotency-Key': idempotencyKey,
+      },
+      body: JSON.stringify({
+        content: formData.content,
+        images: formData.images
+      }),
+    });
 
-      if (createResponse.ok) {
-        const newPost = await createResponse.json();
-        
-        // Then post it immediately
-        const postNowResponse = await fetch(`${API_BASE_URL}/posts/${newPost.id}/post-now`, {
-          method: 'POST',
-        });
-
-        if (postNowResponse.ok) {
-          const result = await postNowResponse.json();
-          onPostCreated(newPost);
-          toast.success('Bài viết đã được đăng ngay!');
-          navigate('/posts');
-        } else {
-          toast.error('Có lỗi khi đăng bài viết');
+    try {
+      // Tạo bài + đăng ở nền: server trả 202 ngay, không chờ upload Facebook.
+      // Lỗi mạng thì gửi lại (tối đa 3 lần) với cùng Idempotency-Key.
+      let response;
+      for (let attempt = 1; ; attempt++) {
+        try {
+          response = await request();
+          break;
+        } catch (networkError) {
+          if (attempt >= 3) throw networkError;
+          await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
         }
+      }
+
+      if (response.status === 202) {
+        const job = await response.json();
+        onPostCreated(job.post);
+        toast.success('Bài viết đang được đăng, trạng thái sẽ cập nhật trong danh sách bài viết.');
+        navigate('/posts');
       } else {
-        const error = await createResponse.json();
+        const error = await response.json();
         toast.error(error.detail || 'Có lỗi xảy ra khi tạo bài viết');
       }
     } catch (error) {
@@ -302,7 +308,7 @@ const CreatePost = ({ onPostCreated, facebookTokens }) => {
                   {uploadedImages.map((image, index) => (
                     <div key={index} className="relative">
                       <img
-                        src={`${API_BASE_URL}${image.url}`}
+                        src={`${API_BASE_URL}${image.thumbnail_url || image.url}`}
                         alt={`Uploaded ${index + 1}`}
                         className="w-full h-32 object-cover rounded-lg"
                       />
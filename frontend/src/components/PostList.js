@@ -194,7 +194,7 @@ const PostList = ({ posts, onPostUpdated, onPostDeleted }) => {
                             <div key={index} className="relative">
                               {image.image_path ? (
                                 <img 
-                                  src={`/uploads/${image.image_path.split('/').pop()}`}
+                                  src={`${API_BASE_URL}/uploads/thumbs/160/${image.image_path.split('/').pop()}`}
                                   alt={`Post image ${index + 1}`}
                                   className="w-full h-20 object-cover rounded-lg"
                                 />